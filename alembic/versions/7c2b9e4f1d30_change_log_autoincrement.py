@@ -0,0 +1,36 @@
+"""change log autoincrement
+
+Revision ID: 7c2b9e4f1d30
+Revises: e1f3a7b2c6d8
+Create Date: 2026-10-18 18:42:13.219874
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2b9e4f1d30'
+down_revision = 'e1f3a7b2c6d8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite reuses the ids after the entries are pruned unless the table is AUTOINCREMENT,
+    # the PostgreSQL sequence never does
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    with op.batch_alter_table('change_log', recreate='always',
+                              table_kwargs=dict(sqlite_autoincrement=True)) as batch_op:
+        pass
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    with op.batch_alter_table('change_log', recreate='always',
+                              table_kwargs=dict(sqlite_autoincrement=False)) as batch_op:
+        pass
@@ -17,6 +17,8 @@ async def prepare_db(db):
     async with db.connect() as conn:
         await conn.execute("DELETE FROM 'jwt_role'")
         await conn.execute("DELETE FROM 'jwt_config'")
+        await conn.execute("DELETE FROM 'jwks_snapshot'")
+        await conn.execute("DELETE FROM 'change_log'")
 
 
 @pytest.fixture
@@ -1,8 +1,13 @@
 from aiohttp import web
 
-from core.database import init_db
+from core.client import init_client_session, close_client_session
+from core.database import init_db, close_db
+from core.executor import init_executor, close_executor
 from core.middlewares import init_middlewares
+from core.nomad_client import init_nomad_client, close_nomad_client
+from core.registry import init_registries
 from core.routes import init_routes
+from core.scheduler import init_jwks_refresher, close_jwks_refresher, init_change_poller, close_change_poller
 
 
 def create_app(loop=None):
@@ -12,8 +17,21 @@ def create_app(loop=None):
         app = web.Application()
 
     app.on_startup.append(init_db)
+    app.on_startup.append(init_registries)
+    app.on_startup.append(init_client_session)
+    app.on_startup.append(init_nomad_client)
+    app.on_startup.append(init_executor)
     app.on_startup.append(init_routes)
     app.on_startup.append(init_middlewares)
+    app.on_startup.append(init_jwks_refresher)
+    app.on_startup.append(init_change_poller)
+
+    app.on_cleanup.append(close_change_poller)
+    app.on_cleanup.append(close_jwks_refresher)
+    app.on_cleanup.append(close_nomad_client)
+    app.on_cleanup.append(close_client_session)
+    app.on_cleanup.append(close_executor)
+    app.on_cleanup.append(close_db)
 
     return app
 
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import threading
+import time
+from collections import OrderedDict
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one in-flight call
+    """
+
+    def __init__(self):
+        self.calls = dict()
+
+    async def run(self, key, coroutine_function, *args, **kwargs):
+        """
+        Awaits the in-flight call by key or starts the new one.
+        Cancellation of a waiter does not cancel the shared call
+        """
+        loop = asyncio.get_event_loop()
+
+        call = self.calls.get(key, None)
+        if call is None or call.done() or call.get_loop() is not loop:
+            call = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            call.add_done_callback(functools.partial(self._forget, key))
+            self.calls[key] = call
+
+        return await asyncio.shield(call)
+
+    def _forget(self, key, call: asyncio.Future):
+        if self.calls.get(key, None) is call:
+            del self.calls[key]
+
+        # Mark the exception as retrieved even if every waiter has been cancelled
+        if not call.cancelled():
+            call.exception()
+
+
+class LruCache:
+    """
+    Size bounded LRU cache, entries may have an expiration (unix) time.
+    Thread-safe, may be used from executor threads
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at=None):
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return default if entry is None else entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,21 @@
+import aiohttp
+
+from core import settings
+
+
+async def init_client_session(app):
+    connector = aiohttp.TCPConnector(limit=settings.http_pool_limit,
+                                     limit_per_host=settings.http_pool_limit_per_host,
+                                     keepalive_timeout=settings.http_keepalive_timeout,
+                                     use_dns_cache=True,
+                                     ttl_dns_cache=settings.http_dns_cache_ttl)
+    timeout = aiohttp.ClientTimeout(total=settings.http_timeout,
+                                    connect=settings.http_connect_timeout)
+
+    app['client_session'] = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout,
+                                                  raise_for_status=False)
+
+
+async def close_client_session(app):
+    await app['client_session'].close()
@@ -1,23 +1,27 @@
 import json
 from json import JSONDecodeError
+from typing import Tuple
 
 from aiohttp import web
-from aiohttp.web_exceptions import HTTPNotFound
+from aiohttp.web_exceptions import HTTPNotFound, HTTPException
 from aiohttp.web_urldispatcher import View
 from jwt import PyJWTError
 from requests import Response
-from sqlalchemy import select, insert, delete
-from sqlalchemy import update
 from sqlalchemy.engine import RowProxy
-from sqlalchemy_aio.base import AsyncResultProxy
+from sqlalchemy.exc import IntegrityError
 
 from core import settings
 from core.exceptions import HTTPApiAdminTokenInvalid, HTTPApiRoleAlreadyExists, HTTPApiRoleDataInvalid, \
     HTTPApiRoleNotExist, HTTPApiBoundClaimsValidationError, HTTPApiNomadClaimsValidationError, HTTPApiConfigDataInvalid, \
     HTTPApiConfigAlreadyExists, HTTPApiConfigNotExist, HTTPApiContentTypeInvalid, HTTPApiRunDataInvalid, \
-    HTTPApiConfigServiceInvalidJwt
-from core.services import BoundClaimsService, NomadClaimsService, ConfigService, NomadService, ViewUtilities
-from core.tables import JwtRole, JwtConfig
+    HTTPApiConfigServiceInvalidJwt, HTTPApiBulkDataInvalid, HTTPApiInvalidJson
+from core.executor import run_cpu_bound
+from core.registry import RoleEntry, ConfigEntry
+from core.repositories import RoleRepository, ConfigRepository, RunRepository, ChangeLogRepository
+from core.scheduler import request_jwks_refresh
+from core.services import BoundClaimsService, NomadClaimsService, ConfigService, NomadService, ViewUtilities, \
+    ParsedToken, NomadClaimsMatcher, CanonicalClaims
+from core.tables import JwtConfig
 
 
 class JsonView(View):
@@ -30,7 +34,7 @@ class JsonView(View):
         return await super()._iter()
 
 
-class AdminView(JsonView):
+class AdminTokenView(View):
     async def _iter(self):
         expected_token = settings.admin_token
         token = self.request.headers.get('Authorization', '')
@@ -40,29 +44,30 @@ class AdminView(JsonView):
         return await super()._iter()
 
 
+class AdminView(AdminTokenView, JsonView):
+    pass
+
+
 class RoleListView(AdminView):
     async def get(self):
         if self.request.query.get('list') is None:
             raise HTTPNotFound()
 
-        query = select([JwtRole]).limit(1000)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
-            result: RowProxy = await row.fetchall()
-
-            response_list = []
-            for value in result:
-                response_list.append(dict(id=value.id,
-                                          role=value.role))
-
-            return web.json_response(response_list)
+        return await ViewUtilities.list_response(self.request,
+                                                 RoleRepository.get_page,
+                                                 lambda value: dict(id=value.id,
+                                                                    role=value.role))
 
 
 class RoleView(AdminView):
-    async def add_role_with_behaviour(self, already_exists_behaviour) -> Response:
+    @staticmethod
+    def get_etag(role_id, claims_hash) -> str:
+        return f'"{role_id}-{claims_hash}"'
+
+    async def add_role_with_behaviour(self, save_behaviour) -> Response:
         """
         Adds claims by role_name
-        :param already_exists_behaviour: Behavioural function, calls if the claims already exists
+        :param save_behaviour: Behavioural function, saves the claims and returns the role id and version
         """
         data = await ViewUtilities.get_request_json(self.request)
 
@@ -88,39 +93,45 @@ class RoleView(AdminView):
         except JSONDecodeError:
             raise HTTPApiNomadClaimsValidationError('ROOT')
 
+        # Compiled once, the run checks nomad_claims with it
+        nomad_matcher = NomadClaimsMatcher(nomad_claims)
+        claims = CanonicalClaims(bound_claims, nomad_claims)
+
         # Dive into database
-        query = select([JwtRole]).where(JwtRole.role == role)
         async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
-
-            result: RowProxy = await row.fetchone()
-            if result is not None:
-                await already_exists_behaviour(role,
-                                               result=result,
-                                               bound_claims=bound_claims,
-                                               nomad_claims=nomad_claims,
-                                               conn=conn)
-                return web.json_response(dict(id=result['id'], ))
-
-            else:
-                result: AsyncResultProxy = await conn.execute(
-                    insert(JwtRole).values(dict(role=role,
-                                                bound_claims=json.dumps(bound_claims),
-                                                nomad_claims=json.dumps(nomad_claims)))
-                )
-            return web.json_response(dict(id=result.inserted_primary_key[0], ))
+            async with conn.begin():
+                role_id, version = await save_behaviour(role,
+                                                        claims=claims,
+                                                        conn=conn)
+                await ChangeLogRepository.add(conn, ChangeLogRepository.ROLE, [role])
+
+        self.request.app['roles'].set(role_id, role, bound_claims, nomad_claims, nomad_matcher,
+                                      claims_hash=claims.hash,
+                                      version=version)
+        return web.json_response(dict(id=role_id, ))
 
     async def put(self):
-        async def edit_if_exists(role: str, result: RowProxy, bound_claims, nomad_claims, conn, *args):
-            query = update(JwtRole).where(JwtRole.id == result['id']).values(bound_claims=json.dumps(bound_claims),
-                                                                             nomad_claims=json.dumps(nomad_claims))
-            await conn.execute(query)
+        async def upsert(role: str, claims: CanonicalClaims, conn):
+            return await RoleRepository.upsert(conn, dict(role=role,
+                                                          bound_claims=claims.bound_claims,
+                                                          nomad_claims=claims.nomad_claims,
+                                                          claims_hash=claims.hash))
 
-        return await self.add_role_with_behaviour(edit_if_exists)
+        return await self.add_role_with_behaviour(upsert)
 
     async def post(self):
-        async def raise_is_exists(role: str, *args, **kwargs):
-            raise HTTPApiRoleAlreadyExists(role)
+        async def raise_is_exists(role: str, claims: CanonicalClaims, conn):
+            # Uniqueness is guarded by the role unique constraint
+            try:
+                role_id = await RoleRepository.insert(conn, dict(role=role,
+                                                                 bound_claims=claims.bound_claims,
+                                                                 nomad_claims=claims.nomad_claims,
+                                                                 claims_hash=claims.hash,
+                                                                 version=1))
+            except IntegrityError:
+                raise HTTPApiRoleAlreadyExists(role)
+
+            return role_id, 1
 
         return await self.add_role_with_behaviour(raise_is_exists)
 
@@ -129,38 +140,157 @@ class RoleView(AdminView):
         if role is None:
             raise HTTPApiRoleDataInvalid('role_name')
 
-        query = select([JwtRole]).where(JwtRole.role == role)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
+        # Unchanged role is confirmed by the registry (kept fresh by the change poller) without the database
+        entry: RoleEntry = self.request.app['roles'].get(role)
+        if entry is not None and entry.claims_hash is not None:
+            etag = RoleView.get_etag(entry.id, entry.claims_hash)
+            if ViewUtilities.is_not_modified(self.request, etag):
+                return web.Response(status=304, headers={'ETag': etag})
 
-            result: RowProxy = await row.fetchone()
+        async with self.request.app['db'].connect() as conn:
+            result: RowProxy = await RoleRepository.get(conn, role)
             if result is None:
                 raise HTTPApiRoleNotExist(role)
 
-            return web.json_response(dict(id=result.id,
-                                          bound_claims=json.loads(result.bound_claims),
-                                          nomad_claims=json.loads(result.nomad_claims),
-                                          )
-                                     )
+        claims_hash = result.claims_hash or CanonicalClaims.get_hash(result.bound_claims, result.nomad_claims)
+        etag = RoleView.get_etag(result.id, claims_hash)
+        if ViewUtilities.is_not_modified(self.request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+
+        # Claims are stored as JSON, they are not decoded
+        return web.Response(text=f'{{"id": {result.id}, '
+                                 f'"bound_claims": {result.bound_claims or "null"}, '
+                                 f'"nomad_claims": {result.nomad_claims or "null"}}}',
+                            content_type='application/json',
+                            headers={'ETag': etag})
 
     async def delete(self):
         role = self.request.match_info.get('role_name', None)
         if role is None:
             raise HTTPApiRoleDataInvalid('role_name')
 
-        query = select([JwtRole]).where(JwtRole.role == role)
         async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
+            async with conn.begin():
+                if not await RoleRepository.delete(conn, role):
+                    raise HTTPApiRoleNotExist(role)
+                await ChangeLogRepository.add(conn, ChangeLogRepository.ROLE, [role])
+
+        self.request.app['roles'].remove(role)
+        return web.json_response(dict(success=True))
 
-            result: RowProxy = await row.fetchone()
-            if result is None:
-                raise HTTPApiRoleNotExist(role)
 
-            await conn.execute(
-                delete(JwtRole).where(JwtRole.role == role)
-            )
+class BulkRoleView(AdminTokenView):
+    """
+    NDJSON role export and import, one {"role", "bound_claims", "nomad_claims"} object per line
+    """
 
-            return web.json_response(dict(success=True))
+    @staticmethod
+    def parse_line(line: bytes) -> dict:
+        data = json.loads(line)
+        if type(data) != dict:
+            raise HTTPApiInvalidJson()
+
+        role = data.get('role', None)
+        if type(role) != str or not role:
+            raise HTTPApiRoleDataInvalid('role')
+        bound_claims = data.get('bound_claims', None)
+        if bound_claims is None:
+            raise HTTPApiRoleDataInvalid('bound_claims')
+        nomad_claims = data.get('nomad_claims', None)
+        if nomad_claims is None:
+            raise HTTPApiRoleDataInvalid('nomad_claims')
+
+        BoundClaimsService.validate(bound_claims)
+        NomadClaimsService.validate(nomad_claims)
+
+        return dict(role=role,
+                    bound_claims=bound_claims,
+                    nomad_claims=nomad_claims,
+                    nomad_matcher=NomadClaimsMatcher(nomad_claims),
+                    claims=CanonicalClaims(bound_claims, nomad_claims))
+
+    async def save_batch(self, batch: dict) -> Tuple[int, int]:
+        values = [dict(role=role,
+                       bound_claims=entry['claims'].bound_claims,
+                       nomad_claims=entry['claims'].nomad_claims,
+                       claims_hash=entry['claims'].hash) for role, entry in batch.items()]
+
+        async with self.request.app['db'].connect() as conn:
+            async with conn.begin():
+                created, updated = await RoleRepository.save_many(conn, values)
+                await ChangeLogRepository.add(conn, ChangeLogRepository.ROLE, created + updated)
+            result = await RoleRepository.get_many(conn, batch.keys())
+
+        for row in result:
+            entry = batch[row.role]
+            self.request.app['roles'].set(row.id, row.role, entry['bound_claims'], entry['nomad_claims'],
+                                          entry['nomad_matcher'],
+                                          claims_hash=row.claims_hash,
+                                          version=row.version)
+
+        return len(created), len(updated)
+
+    async def put(self):
+        """
+        Lines are validated as they are read and saved in batches,
+        the batches before an invalid line stay saved
+        """
+        created = updated = total = 0
+        batch = {}
+        line_number = 0
+        async for line in self.request.content:
+            line_number += 1
+            if not line.strip():
+                continue
+
+            try:
+                entry = BulkRoleView.parse_line(line)
+            except HTTPException as e:
+                raise HTTPApiBulkDataInvalid(line_number, e.reason)
+            except (JSONDecodeError, UnicodeDecodeError) as e:
+                raise HTTPApiBulkDataInvalid(line_number, str(e))
+
+            # The last line of the role wins
+            batch.pop(entry['role'], None)
+            batch[entry['role']] = entry
+
+            if len(batch) >= settings.bulk_batch_size:
+                batch_created, batch_updated = await self.save_batch(batch)
+                created, updated, total = created + batch_created, updated + batch_updated, total + len(batch)
+                batch = {}
+
+        if batch:
+            batch_created, batch_updated = await self.save_batch(batch)
+            created, updated, total = created + batch_created, updated + batch_updated, total + len(batch)
+
+        return web.json_response(dict(created=created,
+                                      updated=updated,
+                                      unchanged=total - created - updated))
+
+    async def get(self):
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        response.enable_chunked_encoding()
+        await response.prepare(self.request)
+
+        after = 0
+        limit = settings.list_page_size
+        while True:
+            async with self.request.app['db'].connect() as conn:
+                result = await RoleRepository.get_export_page(conn, after, limit)
+
+            # Claims are stored as canonical JSON, they are not decoded
+            lines = [f'{{"role":{json.dumps(value.role)},'
+                     f'"bound_claims":{value.bound_claims or "null"},'
+                     f'"nomad_claims":{value.nomad_claims or "null"}}}\n' for value in result]
+            if lines:
+                await response.write(''.join(lines).encode('utf-8'))
+
+            if len(result) < limit:
+                break
+            after = result[-1].id
+
+        await response.write_eof()
+        return response
 
 
 class ConfigView(AdminView):
@@ -174,30 +304,25 @@ class ConfigView(AdminView):
         if bound_issuer is None:
             raise HTTPApiConfigDataInvalid('bound_issuer')
 
-        query = select([JwtConfig]).where(JwtConfig.bound_issuer == bound_issuer)
+        # Uniqueness is guarded by the bound_issuer unique index
         async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
-
-            result: RowProxy = await row.fetchone()
-            if result is not None:
-                raise HTTPApiConfigAlreadyExists(bound_issuer)
-
-            result: AsyncResultProxy = await conn.execute(
-                insert(JwtConfig).values(dict(jwks_url=jwks_url,
-                                              bound_issuer=bound_issuer))
-            )
-            return web.json_response(dict(id=result.inserted_primary_key[0], ))
+            async with conn.begin():
+                try:
+                    config_id = await ConfigRepository.insert(conn, dict(jwks_url=jwks_url,
+                                                                          bound_issuer=bound_issuer))
+                except IntegrityError:
+                    raise HTTPApiConfigAlreadyExists(bound_issuer)
+                await ChangeLogRepository.add(conn, ChangeLogRepository.CONFIG, [bound_issuer])
+
+        self.request.app['issuers'].set(config_id, bound_issuer, jwks_url)
+        request_jwks_refresh(self.request.app)
+        return web.json_response(dict(id=config_id, ))
 
     async def get_list(self):
-        query = select([JwtConfig]).limit(1000)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
-            result: RowProxy = await row.fetchall()
-
-            response_list = [dict(id=value.id,
-                                  bound_issuer=value.bound_issuer) for value in result]
-
-            return web.json_response(response_list)
+        return await ViewUtilities.list_response(self.request,
+                                                 ConfigRepository.get_page,
+                                                 lambda value: dict(id=value.id,
+                                                                    bound_issuer=value.bound_issuer))
 
     async def get(self):
         if self.request.query.get('list') is not None:
@@ -207,17 +332,26 @@ class ConfigView(AdminView):
         if bound_issuer is None:
             raise HTTPApiConfigDataInvalid('bound_issuer')
 
-        query = select([JwtConfig]).where(JwtConfig.bound_issuer == bound_issuer)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
+        # Unchanged config is confirmed by the registry (kept fresh by the change poller) without the database
+        entry: ConfigEntry = self.request.app['issuers'].get(bound_issuer)
+        if entry is not None:
+            etag = ViewUtilities.get_etag(entry.id, entry.bound_issuer, entry.jwks_url)
+            if ViewUtilities.is_not_modified(self.request, etag):
+                return web.Response(status=304, headers={'ETag': etag})
 
-            result: RowProxy = await row.fetchone()
+        async with self.request.app['db'].connect() as conn:
+            result: RowProxy = await ConfigRepository.get(conn, bound_issuer)
             if result is None:
                 raise HTTPApiConfigNotExist(JwtConfig)
 
-            return web.json_response(dict(id=result.id,
-                                          bound_issuer=result.bound_issuer,
-                                          jwks_url=result.jwks_url, ))
+        etag = ViewUtilities.get_etag(result.id, result.bound_issuer, result.jwks_url)
+        if ViewUtilities.is_not_modified(self.request, etag):
+            return web.Response(status=304, headers={'ETag': etag})
+
+        return web.json_response(dict(id=result.id,
+                                      bound_issuer=result.bound_issuer,
+                                      jwks_url=result.jwks_url, ),
+                                 headers={'ETag': etag})
 
     async def delete(self):
         data = await ViewUtilities.get_request_json(self.request)
@@ -226,19 +360,14 @@ class ConfigView(AdminView):
         if bound_issuer is None:
             raise HTTPApiConfigDataInvalid('bound_issuer')
 
-        query = select([JwtConfig]).where(JwtConfig.bound_issuer == bound_issuer)
         async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
+            async with conn.begin():
+                if not await ConfigRepository.delete(conn, bound_issuer):
+                    raise HTTPApiConfigNotExist(bound_issuer)
+                await ChangeLogRepository.add(conn, ChangeLogRepository.CONFIG, [bound_issuer])
 
-            result: RowProxy = await row.fetchone()
-            if result is None:
-                raise HTTPApiConfigNotExist(bound_issuer)
-
-            await conn.execute(
-                delete(JwtConfig).where(JwtConfig.bound_issuer == bound_issuer)
-            )
-
-            return web.json_response(dict(success=True))
+        self.request.app['issuers'].remove(bound_issuer)
+        return web.json_response(dict(success=True))
 
 
 class RunView(JsonView):
@@ -252,47 +381,55 @@ class RunView(JsonView):
         if role is None:
             raise HTTPApiRunDataInvalid('role')
         jwt_data = data.get('jwt', None)
-        if role is None:
+        if jwt_data is None:
             raise HTTPApiRunDataInvalid('jwt')
 
-        # Validate and obtain data from jwt
+        # Decode jwt once, without validation
         try:
-            issuer = ConfigService.get_issuer(jwt_data)
+            token = ParsedToken(jwt_data)
         except PyJWTError as e:
             raise HTTPApiConfigServiceInvalidJwt(str(e))
 
-        query = select([JwtConfig]).where(JwtConfig.bound_issuer == issuer)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
+        issuer = token.issuer
+        config_entry = self.request.app['issuers'].get(issuer)
+        role_entry = self.request.app['roles'].get(role)
+        role_row = None
+        if config_entry is None or role_entry is None:
+            # The config or the role may be created by another instance, both are fetched at once
+            async with self.request.app['db'].connect() as conn:
+                config_row, role_row = await RunRepository.get_config_and_role(
+                    conn,
+                    issuer if config_entry is None else None,
+                    role if role_entry is None else None,
+                )
 
-            result: RowProxy = await row.fetchone()
-            if result is None:
-                raise HTTPApiConfigNotExist(issuer)
+            if config_entry is None:
+                if config_row is None:
+                    raise HTTPApiConfigNotExist(issuer)
+                config_entry = self.request.app['issuers'].set_row(config_row)
 
-            jwks_url = result.jwks_url
-        jwks = await ConfigService.get_jwks(jwks_url)
+        jwks_url = config_entry.jwks_url
+        jwks = await ConfigService.get_jwks(jwks_url, token.kid, session=self.request.app['client_session'])
 
-        data = ConfigService.validate(jwt_data, jwks)  # throws exception if validation fails
+        data = ConfigService.get_cached_payload(token, jwks)
+        if data is None:
+            # throws exception if validation fails
+            data = await run_cpu_bound(self.request.app, ConfigService.verify, token, jwks)
+            ConfigService.remember_payload(token, data)
 
-        # Validate bound_claims on jwt
-        query = select([JwtRole]).where(JwtRole.role == role)
-        async with self.request.app['db'].connect() as conn:
-            row: AsyncResultProxy = await conn.execute(query)
-
-            result: RowProxy = await row.fetchone()
-            if result is None:
+        # Validate bound_claims on jwt, the missing role is reported only for the valid token
+        if role_entry is None:
+            if role_row is None:
                 raise HTTPApiRoleNotExist(role)
+            role_entry = self.request.app['roles'].set_row(role_row)
 
-            bound_claims = json.loads(result.bound_claims)
-            nomad_claims = json.loads(result.nomad_claims)
-
-        BoundClaimsService.check_jwt(data, bound_claims)
+        BoundClaimsService.check_jwt(data, role_entry.bound_claims)
 
         # Prepare HCL and validate nomad_claims
-        json_job = NomadService.transform(job_hcl)
-        NomadClaimsService.check_nomad_config(json_job, nomad_claims)
+        json_job = await NomadService.transform(self.request.app['nomad'], job_hcl)
+        await run_cpu_bound(self.request.app, NomadClaimsService.check_nomad_config, json_job, role_entry.nomad_matcher)
 
         # Finally, run
-        response = NomadService.run(json_job)
+        response = await NomadService.run(self.request.app['nomad'], json_job)
         return web.json_response(dict(success=True,
                                       nomad=response))
@@ -1,14 +1,154 @@
-from sqlalchemy import (
-    create_engine)
-from sqlalchemy_aio import ASYNCIO_STRATEGY
+import asyncio
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.strategies import DefaultEngineStrategy
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy_aio import AlreadyQuit
+from sqlalchemy_aio.asyncio import AsyncioEngine, AsyncioThreadWorker
 
 from core import settings
 
+POOLED_ASYNCIO_STRATEGY = '_pooled_asyncio'
+
+
+class PooledThreadWorker(AsyncioThreadWorker):
+    """
+    Connection worker thread, it is parked for the next connection instead of being stopped on close
+    """
+
+    def __init__(self, engine, loop=None):
+        super().__init__(loop)
+        self.engine = engine
+
+    async def quit(self):
+        if self._has_quit:
+            raise AlreadyQuit
+
+        if self.engine.park_worker(self):
+            self._has_quit = True
+            return
+
+        await super().quit()
+
+    async def stop(self):
+        self._has_quit = False
+        await super().quit()
+
+
+class PooledAsyncioEngine(AsyncioEngine):
+    """
+    sqlalchemy_aio engine that reuses the connection worker threads,
+    sqlalchemy_aio starts a new thread for every connection
+    """
+
+    def __init__(self, pool, dialect, url, idle_workers=0, **kwargs):
+        super().__init__(pool, dialect, url, **kwargs)
+        self.idle_workers = idle_workers
+        self.parked_workers = []
+
+    def _make_worker(self, *, branch_from=None):
+        if branch_from is not None:
+            return super()._make_worker(branch_from=branch_from)
+
+        loop = self._loop or asyncio.get_event_loop()
+        while self.parked_workers:
+            worker = self.parked_workers.pop()
+            if worker._loop is loop:
+                worker._has_quit = False
+                return worker
+
+            # The loop of the worker is gone, the thread is a daemon
+        return PooledThreadWorker(self, self._loop)
+
+    def park_worker(self, worker: PooledThreadWorker) -> bool:
+        if len(self.parked_workers) >= self.idle_workers:
+            return False
+
+        self.parked_workers.append(worker)
+        return True
+
+    async def stop_workers(self):
+        workers, self.parked_workers = self.parked_workers, []
+        for worker in workers:
+            await worker.stop()
+
+
+class PooledAsyncioEngineStrategy(DefaultEngineStrategy):
+    name = POOLED_ASYNCIO_STRATEGY
+    engine_cls = PooledAsyncioEngine
+
+
+PooledAsyncioEngineStrategy()
+
+
+def is_sqlite_file(uri) -> bool:
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f'PRAGMA journal_mode={settings.sqlite_journal_mode}')
+        cursor.execute(f'PRAGMA synchronous={settings.sqlite_synchronous}')
+        cursor.execute(f'PRAGMA mmap_size={settings.sqlite_mmap_size:d}')
+        cursor.execute(f'PRAGMA cache_size={settings.sqlite_cache_size:d}')
+        cursor.execute(f'PRAGMA busy_timeout={settings.sqlite_busy_timeout:d}')
+    finally:
+        cursor.close()
+
+
+def get_engine_options(uri) -> dict:
+    options = dict(pool_pre_ping=settings.db_pool_pre_ping,
+                   pool_recycle=settings.db_pool_recycle)
+
+    if make_url(uri).get_backend_name() == 'sqlite':
+        if not is_sqlite_file(uri):
+            # In-memory database lives in the single connection
+            return options
+
+        # The file database is pooled too, connections are used by the worker threads
+        options.update(poolclass=QueuePool,
+                       connect_args=dict(check_same_thread=False,
+                                         timeout=settings.sqlite_busy_timeout / 1000))
+
+    options.update(pool_size=settings.db_pool_size,
+                   max_overflow=settings.db_max_overflow,
+                   pool_timeout=settings.db_pool_timeout,
+                   idle_workers=settings.db_pool_size + settings.db_max_overflow)
+    return options
+
+
+def create_db_engine(uri=None) -> PooledAsyncioEngine:
+    uri = uri or settings.connection_uri
+    engine = create_engine(uri, strategy=POOLED_ASYNCIO_STRATEGY, **get_engine_options(uri))
+    if is_sqlite_file(uri):
+        event.listen(engine.sync_engine, 'connect', set_sqlite_pragmas)
+
+    return engine
+
+
+async def warm_up_db(engine, size: int):
+    """
+    Opens the pool connections (and their worker threads) before the first request
+    """
+    connections = await asyncio.gather(*[engine.connect() for _ in range(size)])
+    for conn in connections:
+        await conn.scalar('SELECT 1')
+    for conn in connections:
+        await conn.close()
+
 
 async def init_db(app):
-    # app['db'] = await aiopg_sqlite.create_engine(**settings.connection_params, loop=app.loop)
-    app['db'] = create_engine(
-        # In-memory sqlite database cannot be accessed from different
-        # threads, use file.
-        settings.connection_uri, strategy=ASYNCIO_STRATEGY
-    )
+    # In-memory sqlite database cannot be accessed from different
+    # threads, use file.
+    app['db'] = create_db_engine()
+    if settings.db_pool_warm_up > 0:
+        await warm_up_db(app['db'], settings.db_pool_warm_up)
+
+
+async def close_db(app):
+    engine: PooledAsyncioEngine = app['db']
+    await engine.stop_workers()
+    engine.sync_engine.dispose()
@@ -73,6 +73,16 @@ class HTTPApiRunDataInvalid(HTTPBadRequest):
         super().__init__(reason=f'Run data key "{key}" is invalid')
 
 
+class HTTPApiBulkDataInvalid(HTTPBadRequest):
+    def __init__(self, line, message):
+        super().__init__(reason=f'Bulk data line {line} is invalid: {message}')
+
+
+class HTTPApiPageDataInvalid(HTTPBadRequest):
+    def __init__(self, key):
+        super().__init__(reason=f'Page parameter "{key}" is invalid')
+
+
 class HTTPApiContentTypeInvalid(HTTPUnsupportedMediaType):
     def __init__(self):
         super().__init__(reason=f'Supports only "application/json" Content-Type')
@@ -97,6 +107,11 @@ class HTTPApiNomadServiceRunException(HTTPBadRequest):
         super().__init__(reason=f'Run error: {message}')
 
 
+class HTTPApiNomadServiceUnavailable(HTTPServiceUnavailable):
+    def __init__(self, message):
+        super().__init__(reason=f'Nomad is unavailable: {message}')
+
+
 class HTTPApiConfigServiceInvalidJwt(HTTPBadRequest):
     def __init__(self, message):
         super().__init__(reason=f'JWT is invalid: {message}')
@@ -107,6 +122,11 @@ class HTTPApiConfigServiceJwksError(HTTPServiceUnavailable):
         super().__init__(reason=f'Failed to retrieve JWKS from: {url}')
 
 
+class HTTPApiExecutorBusy(HTTPServiceUnavailable):
+    def __init__(self):
+        super().__init__(reason=f'Too many pending requests, try again later')
+
+
 class HTTPApiConfigServiceJWTError(HTTPBadRequest):
     def __init__(self, url):
         super().__init__(reason=f'{url}')
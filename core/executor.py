@@ -0,0 +1,68 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from aiohttp.web_exceptions import HTTPException
+
+from core import settings
+from core.exceptions import HTTPApiExecutorBusy
+
+
+def _call_in_process(function, *args):
+    """
+    HTTP exceptions are not picklable, they are passed to the parent process as (type, reason)
+    """
+    try:
+        return False, function(*args)
+    except HTTPException as e:
+        return True, (type(e), e.reason)
+
+
+async def run_cpu_bound(app, function, *args):
+    """
+    Runs CPU-bound function in the application executor (or inline if the executor is disabled)
+    :raises HTTPApiExecutorBusy: If there are too many pending calls
+    """
+    executor = app['executor']
+    if executor is None:
+        return function(*args)
+
+    if app['executor_pending'] >= settings.cpu_executor_queue:
+        raise HTTPApiExecutorBusy()
+
+    loop = asyncio.get_event_loop()
+    app['executor_pending'] += 1
+    try:
+        if isinstance(executor, ProcessPoolExecutor):
+            failed, result = await loop.run_in_executor(executor, functools.partial(_call_in_process, function, *args))
+        else:
+            failed, result = False, await loop.run_in_executor(executor, functools.partial(function, *args))
+    finally:
+        app['executor_pending'] -= 1
+
+    if failed:
+        exception_type, reason = result
+        exception = exception_type.__new__(exception_type)
+        HTTPException.__init__(exception, reason=reason)
+        raise exception
+
+    return result
+
+
+async def init_executor(app):
+    if settings.cpu_executor == 'thread':
+        app['executor'] = ThreadPoolExecutor(max_workers=settings.cpu_executor_workers)
+    elif settings.cpu_executor == 'process':
+        app['executor'] = ProcessPoolExecutor(max_workers=settings.cpu_executor_workers)
+    else:
+        app['executor'] = None
+
+    app['executor_pending'] = 0
+
+
+async def close_executor(app):
+    # shutdown(wait=False) of the process pool hangs the interpreter exit on Python 3.7 and 3.8,
+    # the pool is waited for in the default executor not to block the loop
+    if app['executor'] is not None:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, functools.partial(app['executor'].shutdown, wait=True))
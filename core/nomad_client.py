@@ -0,0 +1,281 @@
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+import ssl
+import time
+from contextlib import suppress
+from typing import Optional, List
+from urllib.parse import urlparse
+
+import aiohttp
+
+from core import settings
+
+
+class NomadApiError(Exception):
+    """
+    Nomad responded with an error status
+    """
+
+    def __init__(self, status: int, text: str):
+        super().__init__(text)
+        self.status = status
+        self.text = text
+
+
+class NomadUnavailableError(Exception):
+    """
+    Nomad could not be reached or did not respond in time
+    """
+
+
+class NomadConnectionError(NomadUnavailableError):
+    """
+    Connection to Nomad is not established, the request is not sent
+    """
+
+
+def is_ip_address(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class NomadEndpoint:
+    def __init__(self, address: str):
+        self.address = address.rstrip('/')
+        self.host = urlparse(self.address).hostname
+        # Resolved IP addresses, the leader is reported by its IP
+        self.ips = {self.host} if is_ip_address(self.host) else set()
+        # Nomad version reported by the agent, unknown without the agent:read ACL capability
+        self.version = None
+        self.outstanding = 0
+        self.failures = 0
+        self.down_until = 0.
+
+    async def resolve(self):
+        if is_ip_address(self.host):
+            return
+
+        loop = asyncio.get_event_loop()
+        addresses = await loop.getaddrinfo(self.host, None, type=socket.SOCK_STREAM)
+        self.ips = set(value[4][0] for value in addresses)
+
+    def is_healthy(self, now: float) -> bool:
+        return self.down_until <= now
+
+    def mark_success(self):
+        self.failures = 0
+        self.down_until = 0.
+
+    def mark_failure(self):
+        self.failures += 1
+        if self.failures >= settings.nomad_max_failures:
+            self.down_until = time.time() + settings.nomad_down_interval
+
+
+class NomadClient:
+    """
+    Nomad HTTP API client on the shared aiohttp session (pooled keep-alive connections).
+    Calls go to the healthy server with the least outstanding requests, registrations go to the leader.
+    Failed servers are skipped for a while (passive check), check_health probes all of them (active check)
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, addresses: List[str],
+                 token: str = None, namespace: str = None, region: str = None,
+                 timeout: float = None, ssl_context=None):
+        self.session = session
+        self.endpoints = [NomadEndpoint(address) for address in addresses]
+        self.leader = None
+        self.token = token
+        self.namespace = namespace
+        self.region = region
+        self.timeout = aiohttp.ClientTimeout(total=timeout) if timeout else None
+        self.ssl_context = ssl_context
+
+    def get_endpoints(self, leader=False) -> List[NomadEndpoint]:
+        """
+        Returns the endpoints in the order to try: the healthy ones by outstanding requests
+        (the leader first if requested), then the failed ones
+        """
+        now = time.time()
+        endpoints = list(self.endpoints)
+        random.shuffle(endpoints)
+
+        healthy = sorted([value for value in endpoints if value.is_healthy(now)], key=lambda value: value.outstanding)
+        failed = sorted([value for value in endpoints if not value.is_healthy(now)], key=lambda value: value.down_until)
+
+        if leader and self.leader is not None:
+            healthy.sort(key=lambda value: not self.is_leader(value))
+        return healthy + failed
+
+    def is_leader(self, endpoint: NomadEndpoint) -> bool:
+        return self.leader is not None and self.leader in endpoint.ips
+
+    @property
+    def version(self) -> Optional[str]:
+        """
+        Nomad versions of the servers, e.g. "1.6.1" or "1.6.1,1.7.0" while they are upgraded
+        """
+        versions = sorted(set(endpoint.version for endpoint in self.endpoints if endpoint.version is not None))
+        return ','.join(versions) or None
+
+    async def request_endpoint(self, endpoint: NomadEndpoint, method: str, path: str, json: dict = None,
+                               timeout: aiohttp.ClientTimeout = None):
+        params = {}
+        if self.namespace:
+            params['namespace'] = self.namespace
+        if self.region:
+            params['region'] = self.region
+
+        headers = {}
+        if self.token:
+            headers['X-Nomad-Token'] = self.token
+
+        endpoint.outstanding += 1
+        try:
+            async with self.session.request(method, f'{endpoint.address}/v1/{path}',
+                                            params=params,
+                                            headers=headers,
+                                            json=json,
+                                            timeout=timeout or self.timeout,
+                                            ssl=self.ssl_context) as resp:
+                if resp.status in (502, 503, 504):
+                    raise NomadUnavailableError(f'{endpoint.address}: {resp.status} {await resp.text()}')
+                if resp.status != 200:
+                    endpoint.mark_success()
+                    raise NomadApiError(resp.status, await resp.text())
+
+                result = await resp.json(content_type=None)
+        except aiohttp.ClientConnectorError as e:
+            endpoint.mark_failure()
+            raise NomadConnectionError(f'{endpoint.address}: {str(e)}')
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            endpoint.mark_failure()
+            raise NomadUnavailableError(f'{endpoint.address}: {str(e) or type(e).__name__}')
+        except NomadUnavailableError:
+            endpoint.mark_failure()
+            raise
+        finally:
+            endpoint.outstanding -= 1
+
+        endpoint.mark_success()
+        return result
+
+    async def request(self, method: str, path: str, json: dict = None, leader=False, retry_sent=True) -> dict:
+        """
+        Tries the endpoints one by one while they are unavailable.
+        The request that could have reached Nomad is retried only with retry_sent
+        """
+        error = None
+        for endpoint in self.get_endpoints(leader):
+            try:
+                return await self.request_endpoint(endpoint, method, path, json)
+            except NomadConnectionError as e:
+                error = e
+            except NomadUnavailableError as e:
+                if not retry_sent:
+                    raise
+                error = e
+
+        raise error
+
+    async def parse(self, hcl: str, canonicalize=False) -> dict:
+        return await self.request('POST', 'jobs/parse', json=dict(JobHCL=hcl, Canonicalize=canonicalize))
+
+    async def register(self, job_id: str, job: dict) -> dict:
+        return await self.request('POST', f'job/{job_id}', json=dict(Job=job), leader=True, retry_sent=False)
+
+    async def plan(self, job_id: str, job: dict, diff=False) -> dict:
+        return await self.request('POST', f'job/{job_id}/plan', json=dict(Job=job, Diff=diff), leader=True)
+
+    async def read(self, job_id: str) -> dict:
+        return await self.request('GET', f'job/{job_id}')
+
+    async def check_endpoint(self, endpoint: NomadEndpoint, timeout: aiohttp.ClientTimeout) -> str:
+        """
+        Returns the leader known by the endpoint, updates the endpoint version
+        """
+        leader = await self.request_endpoint(endpoint, 'GET', 'status/leader', timeout=timeout)
+        try:
+            agent = await self.request_endpoint(endpoint, 'GET', 'agent/self', timeout=timeout)
+            endpoint.version = agent['member']['Tags']['build']
+        except (NomadApiError, NomadUnavailableError, TypeError, KeyError) as e:
+            logging.debug(f'Failed to get the Nomad version of {endpoint.address}: {str(e)}')
+
+        return leader
+
+    async def check_health(self):
+        """
+        Probes every endpoint and updates the leader, e.g. "10.0.0.1:4647" (RPC address), and the versions.
+        The endpoint host names are resolved again to match the leader IP
+        """
+        resolved = await asyncio.gather(*[endpoint.resolve() for endpoint in self.endpoints], return_exceptions=True)
+        for endpoint, result in zip(self.endpoints, resolved):
+            if isinstance(result, Exception):
+                logging.warning(f'Failed to resolve the Nomad server {endpoint.host}: {str(result)}')
+
+        timeout = aiohttp.ClientTimeout(total=settings.nomad_health_timeout)
+        results = await asyncio.gather(*[self.check_endpoint(endpoint, timeout) for endpoint in self.endpoints],
+                                       return_exceptions=True)
+        leader = self.leader
+        for endpoint, result in zip(self.endpoints, results):
+            if isinstance(result, str) and result:
+                leader = result.rsplit(':', 1)[0].strip('[]')
+            elif isinstance(result, Exception) and not isinstance(result, NomadApiError):
+                logging.warning(f'Nomad health check failed: {str(result)}')
+
+        if leader != self.leader:
+            self.leader = leader
+            if not any(self.is_leader(endpoint) for endpoint in self.endpoints):
+                logging.warning(f'Nomad leader {leader} does not match the configured addresses, '
+                                f'registrations are not routed to it')
+
+
+def get_ssl_context() -> Optional[object]:
+    """
+    Returns the aiohttp ssl argument: None for the default verification, False to skip it or the SSLContext
+    """
+    if not settings.nomad_cacert and not settings.nomad_client_cert:
+        return False if settings.nomad_skip_verify else None
+
+    context = ssl.create_default_context(cafile=settings.nomad_cacert or None)
+    if settings.nomad_skip_verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if settings.nomad_client_cert:
+        context.load_cert_chain(settings.nomad_client_cert, settings.nomad_client_key or None)
+
+    return context
+
+
+async def init_nomad_client(app):
+    app['nomad'] = NomadClient(app['client_session'], settings.nomad_addrs,
+                               token=settings.nomad_token or None,
+                               namespace=settings.nomad_namespace or None,
+                               region=settings.nomad_region or None,
+                               timeout=settings.nomad_timeout,
+                               ssl_context=get_ssl_context())
+    app['nomad_health_checker'] = asyncio.ensure_future(nomad_health_checker(app))
+
+
+async def nomad_health_checker(app):
+    while True:
+        try:
+            await app['nomad'].check_health()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Nomad health check failed')
+
+        await asyncio.sleep(settings.nomad_health_interval)
+
+
+async def close_nomad_client(app):
+    app['nomad_health_checker'].cancel()
+    with suppress(asyncio.CancelledError):
+        await app['nomad_health_checker']
@@ -0,0 +1,136 @@
+import json
+import logging
+import time
+
+from aiohttp.web_exceptions import HTTPException
+from sqlalchemy.engine import RowProxy
+
+from core import settings
+from core.repositories import RoleRepository, ConfigRepository, ChangeLogRepository
+from core.services import NomadClaimsMatcher
+
+
+class RoleEntry:
+    def __init__(self, id, role, bound_claims: dict, nomad_claims: dict, nomad_matcher: NomadClaimsMatcher,
+                 claims_hash=None, version=None):
+        self.id = id
+        self.role = role
+        self.bound_claims = bound_claims
+        self.nomad_claims = nomad_claims
+        self.nomad_matcher = nomad_matcher
+        self.claims_hash = claims_hash
+        self.version = version
+
+
+class RoleRegistry:
+    """
+    Decoded claims of the roles. Warmed up on startup and updated by the admin views,
+    so the run does not touch the database for the role
+    """
+
+    def __init__(self):
+        self.roles = dict()
+
+    def __len__(self):
+        return len(self.roles)
+
+    def get(self, role) -> RoleEntry:
+        return self.roles.get(role, None)
+
+    def set(self, id, role, bound_claims: dict, nomad_claims: dict,
+            nomad_matcher: NomadClaimsMatcher = None, claims_hash=None, version=None) -> RoleEntry:
+        """
+        :param nomad_matcher: Compiled nomad_claims, compiled here if not provided
+        """
+        if nomad_matcher is None:
+            nomad_matcher = NomadClaimsMatcher(nomad_claims)
+
+        entry = RoleEntry(id, role, bound_claims, nomad_claims, nomad_matcher, claims_hash, version)
+        self.roles[role] = entry
+        return entry
+
+    def set_row(self, row: RowProxy) -> RoleEntry:
+        """
+        Claims are decoded and compiled only if the row hash differs from the registered one
+        """
+        entry = self.roles.get(row.role, None)
+        if entry is not None and row.claims_hash is not None and entry.claims_hash == row.claims_hash:
+            entry.id = row.id
+            entry.version = row.version
+            return entry
+
+        return self.set(row.id, row.role, json.loads(row.bound_claims), json.loads(row.nomad_claims),
+                        claims_hash=row.claims_hash,
+                        version=row.version)
+
+    def set_rows(self, rows):
+        """
+        Registers the rows, the invalid ones are logged and skipped
+        """
+        for value in rows:
+            try:
+                self.set_row(value)
+            except HTTPException as e:
+                logging.warning(f'Role "{value.role}" is not loaded: {e.reason}')
+            except (TypeError, ValueError) as e:
+                logging.warning(f'Role "{value.role}" is not loaded: {str(e)}')
+
+    def remove(self, role):
+        self.roles.pop(role, None)
+
+
+class ConfigEntry:
+    def __init__(self, id, bound_issuer, jwks_url):
+        self.id = id
+        self.bound_issuer = bound_issuer
+        self.jwks_url = jwks_url
+
+
+class IssuerRegistry:
+    """
+    JWT configs by the bound issuer. Warmed up on startup and updated by the admin views
+    """
+
+    def __init__(self):
+        self.issuers = dict()
+
+    def __len__(self):
+        return len(self.issuers)
+
+    def __iter__(self):
+        return iter(list(self.issuers.values()))
+
+    def get(self, bound_issuer) -> ConfigEntry:
+        return self.issuers.get(bound_issuer, None)
+
+    def set(self, id, bound_issuer, jwks_url) -> ConfigEntry:
+        entry = ConfigEntry(id, bound_issuer, jwks_url)
+        self.issuers[bound_issuer] = entry
+        return entry
+
+    def set_row(self, row: RowProxy) -> ConfigEntry:
+        return self.set(row.id, row.bound_issuer, row.jwks_url)
+
+    def remove(self, bound_issuer):
+        self.issuers.pop(bound_issuer, None)
+
+
+async def init_registries(app):
+    roles = RoleRegistry()
+    issuers = IssuerRegistry()
+
+    async with app['db'].connect() as conn:
+        # Changes made while the tables are loaded are applied again by the change poller,
+        # the window is applied again too, it may hold the transactions not committed yet
+        change_log_id = await ChangeLogRepository.get_last_id(conn, time.time() - settings.change_poll_window)
+        role_rows = await RoleRepository.get_all(conn)
+        config_rows = await ConfigRepository.get_all(conn)
+
+    roles.set_rows(role_rows)
+    for value in config_rows:
+        issuers.set_row(value)
+
+    app['roles'] = roles
+    app['issuers'] = issuers
+    app['change_log_id'] = change_log_id
+    app['change_log_gaps'] = dict()
@@ -0,0 +1,307 @@
+import time
+from collections import namedtuple
+from typing import Optional, Tuple, Iterable, List
+
+from sqlalchemy import select, insert, update, delete, text, case, func
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import RowProxy
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy_aio.base import AsyncResultProxy
+
+from core.tables import JwtRole, JwtConfig, JwksSnapshot, ChangeLog
+
+RoleRow = namedtuple('RoleRow', [column.name for column in JwtRole.__table__.columns])
+ConfigRow = namedtuple('ConfigRow', [column.name for column in JwtConfig.__table__.columns])
+
+
+async def fetch_one(conn, query) -> Optional[RowProxy]:
+    row: AsyncResultProxy = await conn.execute(query)
+    return await row.fetchone()
+
+
+async def fetch_all(conn, query) -> List[RowProxy]:
+    row: AsyncResultProxy = await conn.execute(query)
+    return await row.fetchall()
+
+
+class RoleRepository:
+    @staticmethod
+    async def get(conn, role: str) -> Optional[RowProxy]:
+        return await fetch_one(conn, select([JwtRole]).where(JwtRole.role == role))
+
+    @staticmethod
+    async def get_many(conn, roles: Iterable[str]) -> List[RowProxy]:
+        return await fetch_all(conn, select([JwtRole]).where(JwtRole.role.in_(list(roles))))
+
+    @staticmethod
+    async def get_all(conn, limit: int = None) -> List[RowProxy]:
+        return await fetch_all(conn, select([JwtRole]).limit(limit))
+
+    @staticmethod
+    async def get_page(conn, after: int, limit: int) -> List[RowProxy]:
+        query = select([JwtRole.id, JwtRole.role]).where(JwtRole.id > after).order_by(JwtRole.id).limit(limit)
+        return await fetch_all(conn, query)
+
+    @staticmethod
+    async def get_export_page(conn, after: int, limit: int) -> List[RowProxy]:
+        query = select([JwtRole.id, JwtRole.role, JwtRole.bound_claims, JwtRole.nomad_claims]) \
+            .where(JwtRole.id > after) \
+            .order_by(JwtRole.id) \
+            .limit(limit)
+        return await fetch_all(conn, query)
+
+    @staticmethod
+    async def insert(conn, values: dict) -> int:
+        result: AsyncResultProxy = await conn.execute(insert(JwtRole).values(values))
+        return result.inserted_primary_key[0]
+
+    @staticmethod
+    def get_upsert_query(conn, returning=False):
+        """
+        Returns the statement inserting the role or updating the existing one,
+        the version is increased only if claims_hash changes.
+        Its parameters are the role, bound_claims, nomad_claims, claims_hash and version (1).
+        Returns None if the database does not support it (SQLite before 3.24)
+        """
+        if conn.dialect.name == 'postgresql':
+            query = postgresql.insert(JwtRole)
+            query = query.on_conflict_do_update(
+                index_elements=[JwtRole.role],
+                set_=dict(bound_claims=query.excluded.bound_claims,
+                          nomad_claims=query.excluded.nomad_claims,
+                          claims_hash=query.excluded.claims_hash,
+                          version=case([(JwtRole.claims_hash.isnot_distinct_from(query.excluded.claims_hash),
+                                         JwtRole.version)],
+                                       else_=JwtRole.version + 1)),
+            )
+            return query.returning(JwtRole.id, JwtRole.version) if returning else query
+
+        if conn.dialect.name != 'sqlite' or conn.dialect.dbapi.sqlite_version_info < (3, 24):
+            return None
+
+        # SQLAlchemy 1.3 has no SQLite upsert construct
+        return text(
+            'INSERT INTO jwt_role (role, bound_claims, nomad_claims, claims_hash, version) '
+            'VALUES (:role, :bound_claims, :nomad_claims, :claims_hash, :version) '
+            'ON CONFLICT (role) DO UPDATE SET '
+            'bound_claims = excluded.bound_claims, '
+            'nomad_claims = excluded.nomad_claims, '
+            'claims_hash = excluded.claims_hash, '
+            'version = CASE WHEN jwt_role.claims_hash IS excluded.claims_hash '
+            'THEN jwt_role.version ELSE jwt_role.version + 1 END'
+            + (' RETURNING id, version' if returning else '')
+        )
+
+    @staticmethod
+    def is_returning_supported(conn) -> bool:
+        if conn.dialect.name == 'sqlite':
+            return conn.dialect.dbapi.sqlite_version_info >= (3, 35)
+        return conn.dialect.name == 'postgresql'
+
+    @staticmethod
+    async def insert_or_update(conn, values: dict):
+        """
+        Upsert by two statements for the databases without it, must be run in a transaction.
+        The failed insert does not abort the SQLite transaction
+        """
+        try:
+            await conn.execute(insert(JwtRole).values(dict(values, version=1)))
+        except IntegrityError:
+            query = update(JwtRole).where(JwtRole.role == values['role']).values(
+                bound_claims=values['bound_claims'],
+                nomad_claims=values['nomad_claims'],
+                claims_hash=values['claims_hash'],
+                version=case([(JwtRole.claims_hash == values['claims_hash'], JwtRole.version)],
+                             else_=JwtRole.version + 1),
+            )
+            await conn.execute(query)
+
+    @staticmethod
+    async def save_many(conn, values: List[dict]) -> Tuple[List[str], List[str]]:
+        """
+        Inserts the new roles and updates the changed ones (by claims_hash) in one transaction,
+        values are the role, bound_claims, nomad_claims and claims_hash dicts.
+        Returns the created and the updated roles.
+        The roles are upserted, the role created concurrently is updated instead of failing the batch
+        """
+        existing = {row.role: row for row in await RoleRepository.get_many(conn, [value['role'] for value in values])}
+
+        created = []
+        updated = []
+        changes = []
+        for value in values:
+            row = existing.get(value['role'], None)
+            if row is None:
+                created.append(value['role'])
+            elif row.claims_hash != value['claims_hash']:
+                updated.append(value['role'])
+            else:
+                continue
+
+            changes.append(dict(value, version=1))
+
+        query = RoleRepository.get_upsert_query(conn)
+        async with conn.begin():
+            if query is None:
+                for value in changes:
+                    await RoleRepository.insert_or_update(conn, value)
+            elif changes:
+                await conn.execute(query, changes)
+
+        return created, updated
+
+    @staticmethod
+    async def upsert(conn, values: dict) -> Tuple[int, int]:
+        """
+        Inserts the role or updates the existing one in a single statement,
+        the version is increased only if claims_hash changes.
+        values are the role, bound_claims, nomad_claims and claims_hash.
+        SQLite before 3.24 has no upsert, the insert and the update are run in one transaction.
+        Returns the id and the version
+        """
+        values = dict(values, version=1)
+        returning = RoleRepository.is_returning_supported(conn)
+        query = RoleRepository.get_upsert_query(conn, returning)
+
+        # The SQLite commit fails while the RETURNING rows are not fetched, it is done after
+        async with conn.begin():
+            if query is None:
+                await RoleRepository.insert_or_update(conn, values)
+            elif returning:
+                rows: AsyncResultProxy = await conn.execute(query, values)
+                result: RowProxy = (await rows.fetchall())[0]
+                return result.id, result.version
+            else:
+                await conn.execute(query, values)
+
+            result: RowProxy = await fetch_one(conn, select([JwtRole.id, JwtRole.version])
+                                               .where(JwtRole.role == values['role']))
+        return result.id, result.version
+
+    @staticmethod
+    async def delete(conn, role: str) -> bool:
+        result: AsyncResultProxy = await conn.execute(delete(JwtRole).where(JwtRole.role == role))
+        return result.rowcount > 0
+
+
+class ConfigRepository:
+    @staticmethod
+    async def get(conn, bound_issuer: str) -> Optional[RowProxy]:
+        return await fetch_one(conn, select([JwtConfig]).where(JwtConfig.bound_issuer == bound_issuer))
+
+    @staticmethod
+    async def get_all(conn, limit: int = None) -> List[RowProxy]:
+        return await fetch_all(conn, select([JwtConfig]).limit(limit))
+
+    @staticmethod
+    async def get_page(conn, after: int, limit: int) -> List[RowProxy]:
+        query = select([JwtConfig.id, JwtConfig.bound_issuer]) \
+            .where(JwtConfig.id > after) \
+            .order_by(JwtConfig.id) \
+            .limit(limit)
+        return await fetch_all(conn, query)
+
+    @staticmethod
+    async def insert(conn, values: dict) -> int:
+        """
+        Raises IntegrityError if the issuer already exists
+        """
+        result: AsyncResultProxy = await conn.execute(insert(JwtConfig).values(values))
+        return result.inserted_primary_key[0]
+
+    @staticmethod
+    async def get_many(conn, bound_issuers: Iterable[str]) -> List[RowProxy]:
+        return await fetch_all(conn, select([JwtConfig]).where(JwtConfig.bound_issuer.in_(list(bound_issuers))))
+
+    @staticmethod
+    async def delete(conn, bound_issuer: str) -> bool:
+        result: AsyncResultProxy = await conn.execute(delete(JwtConfig).where(JwtConfig.bound_issuer == bound_issuer))
+        return result.rowcount > 0
+
+
+class ChangeLogRepository:
+    ROLE = 'role'
+    CONFIG = 'config'
+
+    @staticmethod
+    async def add(conn, entity: str, keys: Iterable[str]):
+        now = time.time()
+        values = [dict(entity=entity, key=key, created_at=now) for key in keys]
+        if values:
+            await conn.execute(insert(ChangeLog), values)
+
+    @staticmethod
+    async def get_last_id(conn, created_before: float = None) -> int:
+        query = select([func.max(ChangeLog.id)])
+        if created_before is not None:
+            query = query.where(ChangeLog.created_at < created_before)
+
+        row: AsyncResultProxy = await conn.execute(query)
+        return await row.scalar() or 0
+
+    @staticmethod
+    async def get_many(conn, ids: Iterable[int]) -> List[RowProxy]:
+        return await fetch_all(conn, select([ChangeLog]).where(ChangeLog.id.in_(list(ids))).order_by(ChangeLog.id))
+
+    @staticmethod
+    async def get_after(conn, after: int, limit: int) -> List[RowProxy]:
+        query = select([ChangeLog]).where(ChangeLog.id > after).order_by(ChangeLog.id).limit(limit)
+        return await fetch_all(conn, query)
+
+    @staticmethod
+    async def delete_before(conn, created_at: float):
+        await conn.execute(delete(ChangeLog).where(ChangeLog.created_at < created_at))
+
+
+class RunRepository:
+    @staticmethod
+    async def get_config_and_role(conn, bound_issuer: Optional[str], role: Optional[str]) \
+            -> Tuple[Optional[ConfigRow], Optional[RoleRow]]:
+        """
+        Resolves the issuer config and the role in one query, pass None to skip one of them.
+        The role is None if the config does not exist
+        """
+        if bound_issuer is None:
+            return None, await RoleRepository.get(conn, role) if role is not None else None
+        if role is None:
+            return await ConfigRepository.get(conn, bound_issuer), None
+
+        config_table = JwtConfig.__table__
+        role_table = JwtRole.__table__
+        query = select([*config_table.columns, *role_table.columns]) \
+            .select_from(config_table.outerjoin(role_table, role_table.c.role == role)) \
+            .where(config_table.c.bound_issuer == bound_issuer) \
+            .apply_labels()
+
+        result: RowProxy = await fetch_one(conn, query)
+        if result is None:
+            return None, None
+
+        config_row = ConfigRow(*[result[column] for column in config_table.columns])
+        role_row = None
+        if result[role_table.c.id] is not None:
+            role_row = RoleRow(*[result[column] for column in role_table.columns])
+
+        return config_row, role_row
+
+
+class JwksSnapshotRepository:
+    @staticmethod
+    async def get_all(conn) -> List[RowProxy]:
+        return await fetch_all(conn, select([JwksSnapshot]))
+
+    @staticmethod
+    async def save(conn, jwks_url: str, values: dict):
+        result: AsyncResultProxy = await conn.execute(
+            update(JwksSnapshot).where(JwksSnapshot.jwks_url == jwks_url).values(values)
+        )
+        if result.rowcount == 0:
+            await conn.execute(insert(JwksSnapshot).values(dict(jwks_url=jwks_url, **values)))
+
+    @staticmethod
+    async def delete_except(conn, jwks_urls: Iterable[str]):
+        jwks_urls = list(jwks_urls)
+        query = delete(JwksSnapshot)
+        if jwks_urls:
+            query = query.where(JwksSnapshot.jwks_url.notin_(jwks_urls))
+        await conn.execute(query)
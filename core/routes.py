@@ -1,4 +1,4 @@
-from core.controllers import RoleView, RoleListView, ConfigView, RunView
+from core.controllers import RoleView, RoleListView, ConfigView, RunView, BulkRoleView
 
 
 async def init_routes(app):
@@ -6,3 +6,4 @@ async def init_routes(app):
     app.router.add_view('/role/{role_name}', RoleView)
     app.router.add_view('/config/', ConfigView)
     app.router.add_view('/run/', RunView)
+    app.router.add_view('/bulk/role/', BulkRoleView)
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import suppress
+
+from core import settings
+from core.repositories import JwksSnapshotRepository, ChangeLogRepository, RoleRepository, ConfigRepository
+from core.services import ConfigService, JwksEntry
+
+
+def jittered(interval):
+    jitter = settings.jwks_refresh_jitter
+    return interval * random.uniform(1 - jitter, 1 + jitter)
+
+
+def get_jwks_urls(app) -> set:
+    return set(entry.jwks_url for entry in app['issuers'])
+
+
+async def load_jwks_snapshots(app):
+    """
+    Fills the JWKS cache with the persisted documents, they are revalidated by the next refresh
+    """
+    async with app['db'].connect() as conn:
+        result = await JwksSnapshotRepository.get_all(conn)
+
+    for value in result:
+        if value.jwks_url in ConfigService.jwks_cache:
+            continue
+
+        entry = JwksEntry(json.loads(value.jwks), 0,
+                          etag=value.etag,
+                          last_modified=value.last_modified,
+                          validated_at=value.validated_at)
+        entry.persisted = True
+        ConfigService.jwks_cache[value.jwks_url] = entry
+
+
+async def save_jwks_snapshots(app, urls):
+    """
+    Persists changed JWKS of the configured issuers, removes snapshots of the others
+    """
+    async with app['db'].connect() as conn:
+        for url in urls:
+            entry: JwksEntry = ConfigService.jwks_cache.get(url, None)
+            if entry is None or entry.persisted:
+                continue
+
+            values = dict(jwks=json.dumps(entry.jwks),
+                          etag=entry.etag,
+                          last_modified=entry.last_modified,
+                          validated_at=entry.validated_at)
+
+            await JwksSnapshotRepository.save(conn, url, values)
+            entry.persisted = True
+
+        await JwksSnapshotRepository.delete_except(conn, urls)
+
+
+async def refresh_jwks(app):
+    """
+    Downloads JWKS of every configured issuer if it is missing or expires before the next refresh
+    """
+    urls = list(get_jwks_urls(app))
+    horizon = settings.jwks_refresh_interval * (1 + settings.jwks_refresh_jitter) + settings.jwks_refresh_margin
+
+    results = await asyncio.gather(*[ConfigService.prefetch_jwks(url, horizon, app['client_session'])
+                                     for url in urls],
+                                   return_exceptions=True)
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            logging.warning(f'Failed to refresh JWKS from {url}: {str(result)}')
+
+    await save_jwks_snapshots(app, urls)
+
+
+async def jwks_refresher(app):
+    event: asyncio.Event = app['jwks_refresh_event']
+    while True:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(event.wait(), timeout=jittered(settings.jwks_refresh_interval))
+        event.clear()
+
+        try:
+            await refresh_jwks(app)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('JWKS refresh failed')
+
+
+def request_jwks_refresh(app):
+    """
+    Wakes up the refresher, e.g. when the config has been changed
+    """
+    app['jwks_refresh_event'].set()
+
+
+async def init_jwks_refresher(app):
+    app['jwks_refresh_event'] = asyncio.Event()
+
+    try:
+        await load_jwks_snapshots(app)
+    except Exception:
+        logging.exception('Failed to load JWKS snapshots')
+
+    # The first download is awaited to serve deploys from the cache right after the start
+    try:
+        await asyncio.wait_for(refresh_jwks(app), timeout=settings.jwks_prefetch_timeout)
+    except asyncio.TimeoutError:
+        logging.warning('JWKS prefetch timed out, continuing in background')
+    except Exception:
+        logging.exception('JWKS prefetch failed')
+
+    app['jwks_refresher'] = asyncio.ensure_future(jwks_refresher(app))
+
+
+async def close_jwks_refresher(app):
+    app['jwks_refresher'].cancel()
+    with suppress(asyncio.CancelledError):
+        await app['jwks_refresher']
+
+
+async def apply_changes(app) -> int:
+    """
+    Reloads the roles and the configs changed after the last applied change log entry,
+    returns the number of the applied entries.
+    The ids are taken on insert, but the transactions may commit in a different order (PostgreSQL):
+    the ids skipped by the cursor are re-checked for CHANGE_POLL_WINDOW seconds, reloading is idempotent
+    """
+    now = time.time()
+    gaps: dict = app['change_log_gaps']
+    for key, skipped_at in list(gaps.items()):
+        # Rolled back or not committed in time
+        if skipped_at < now - settings.change_poll_window:
+            del gaps[key]
+
+    async with app['db'].connect() as conn:
+        late = await ChangeLogRepository.get_many(conn, gaps) if gaps else []
+        changes = await ChangeLogRepository.get_after(conn, app['change_log_id'], settings.change_poll_batch)
+        if not changes and not late:
+            return 0
+
+        roles = set(value.key for value in late + changes if value.entity == ChangeLogRepository.ROLE)
+        issuers = set(value.key for value in late + changes if value.entity == ChangeLogRepository.CONFIG)
+        role_rows = await RoleRepository.get_many(conn, roles) if roles else []
+        config_rows = await ConfigRepository.get_many(conn, issuers) if issuers else []
+
+    app['roles'].set_rows(role_rows)
+    for role in roles - set(value.role for value in role_rows):
+        app['roles'].remove(role)
+
+    for value in config_rows:
+        app['issuers'].set_row(value)
+    for issuer in issuers - set(value.bound_issuer for value in config_rows):
+        app['issuers'].remove(issuer)
+    if issuers:
+        request_jwks_refresh(app)
+
+    for value in late:
+        del gaps[value.id]
+
+    if changes:
+        ids = set(value.id for value in changes)
+        for key in range(app['change_log_id'] + 1, changes[-1].id):
+            if key not in ids:
+                gaps[key] = now
+        app['change_log_id'] = changes[-1].id
+
+    return len(late) + len(changes)
+
+
+async def change_poller(app):
+    pruned_at = time.time()
+    while True:
+        await asyncio.sleep(jittered(settings.change_poll_interval))
+
+        try:
+            while await apply_changes(app) >= settings.change_poll_batch:
+                pass
+
+            if time.time() - pruned_at >= settings.change_log_retention / 10:
+                async with app['db'].connect() as conn:
+                    await ChangeLogRepository.delete_before(conn, time.time() - settings.change_log_retention)
+                pruned_at = time.time()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Change log poll failed')
+
+
+async def init_change_poller(app):
+    app['change_poller'] = asyncio.ensure_future(change_poller(app))
+
+
+async def close_change_poller(app):
+    app['change_poller'].cancel()
+    with suppress(asyncio.CancelledError):
+        await app['change_poller']
@@ -1,15 +1,46 @@
+import asyncio
+import hashlib
 import json
+import logging
+import os
 import re
+import time
+from contextlib import suppress
+from typing import Tuple, Callable, Optional
 
 import aiohttp
 import jwt
 import jwt.algorithms
-import nomad
+from aiohttp import web
 from jwt import PyJWTError
+from jwt.utils import base64url_decode
 
+from core import settings
+from core.cache import SingleFlight, LruCache
 from core.exceptions import HTTPApiNomadClaimsValidationError, HTTPApiNomadClaimsCheckError, \
     HTTPApiBoundClaimsValidationError, HTTPApiNomadServiceTransformException, HTTPApiNomadServiceRunException, \
-    HTTPApiConfigServiceJWTError, HTTPApiBoundClaimsCheckError, HTTPApiInvalidJson, HTTPApiEmptyBody
+    HTTPApiConfigServiceJWTError, HTTPApiBoundClaimsCheckError, HTTPApiInvalidJson, HTTPApiEmptyBody, \
+    HTTPApiConfigServiceJwksError, HTTPApiPageDataInvalid, HTTPApiNomadServiceUnavailable
+from core.nomad_client import NomadClient, NomadApiError, NomadUnavailableError
+
+
+class CanonicalClaims:
+    """
+    Canonical serialization of the role claims: equal claims have equal text and hash
+    """
+
+    def __init__(self, bound_claims: dict, nomad_claims: dict):
+        self.bound_claims = CanonicalClaims.dumps(bound_claims)
+        self.nomad_claims = CanonicalClaims.dumps(nomad_claims)
+        self.hash = CanonicalClaims.get_hash(self.bound_claims, self.nomad_claims)
+
+    @staticmethod
+    def dumps(claims) -> str:
+        return json.dumps(claims, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    @staticmethod
+    def get_hash(bound_claims: str, nomad_claims: str) -> str:
+        return hashlib.sha256(f'{bound_claims}\n{nomad_claims}'.encode('utf-8')).hexdigest()
 
 
 class BoundClaimsService:
@@ -123,99 +154,593 @@ class NomadClaimsService:
         return True
 
     @staticmethod
-    def _check_nomad_config_internal_partial(config_value, validator_value, origin_key):
-        if type(validator_value) == list or (type(validator_value) == dict and len(validator_value) > 0):
-            NomadClaimsService._check_nomad_config_internal(config_value, validator_value, origin_key)
-            return
+    def compile(validator, origin_key='ROOT'):
+        """
+        Compiles nomad_claims into the matcher tree, regexes are compiled once
+        :return: Matcher node or None if nothing has to be checked
+        """
+        if type(validator) == dict and len(validator) > 0:
+            children = []
+            for key, validator_value in validator.items():
+                claim = NomadClaimsService.compile(validator_value, f'{origin_key}.{key}')
+                if claim is not None:
+                    children.append((key, claim))
+
+            return DictClaim(tuple(children)) if children else None
 
-        if type(validator_value) == str:
-            if not re.match(validator_value, config_value):
-                raise HTTPApiNomadClaimsCheckError(origin_key)
-        elif type(validator_value) == int:
-            if validator_value != config_value:
-                raise HTTPApiNomadClaimsCheckError(origin_key)
+        if type(validator) == list:
+            if len(validator) == 0:
+                return None
 
-    @staticmethod
-    def _check_nomad_config_internal(config, validator, origin_key):
-        if type(validator) == dict:
-            for key in validator:
-                value = config.get(key, None)
-                if value is None:
-                    continue
+            claim = NomadClaimsService.compile(validator[0], f'{origin_key}.0')
+            return ListClaim(claim) if claim is not None else None
 
-                validator_value = validator[key]
-                NomadClaimsService._check_nomad_config_internal_partial(value, validator_value, f'{origin_key}.{key}')
+        if type(validator) == str:
+            try:
+                return RegexClaim(re.compile(validator))
+            except re.error:
+                raise HTTPApiNomadClaimsValidationError(f'{origin_key} (invalid regex)')
 
-        if type(validator) == list:
-            if len(validator) == 0:
-                return
+        if type(validator) == int:
+            return EqualClaim(validator)
 
-            validator_value = validator[0]
-            for i, value in enumerate(config):
-                NomadClaimsService._check_nomad_config_internal_partial(value, validator_value, f'{origin_key}.{i}')
+        return None
 
     @staticmethod
     def check_nomad_config(config, validator):
-        NomadClaimsService._check_nomad_config_internal(config, validator, 'ROOT')
+        """
+        :param validator: nomad_claims or the compiled NomadClaimsMatcher
+        """
+        if not isinstance(validator, NomadClaimsMatcher):
+            validator = NomadClaimsMatcher(validator)
+
+        validator.check(config)
         return True
 
 
+class ClaimMismatch(Exception):
+    """
+    Raised by the matcher nodes, the path is collected while unwinding
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.path = []
+
+
+class RegexClaim:
+    __slots__ = ('pattern',)
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def check(self, value):
+        if type(value) != str or self.pattern.match(value) is None:
+            raise ClaimMismatch()
+
+
+class EqualClaim:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def check(self, value):
+        if self.value != value:
+            raise ClaimMismatch()
+
+
+class DictClaim:
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = children
+
+    def check(self, config):
+        if type(config) != dict:
+            raise ClaimMismatch()
+
+        for key, claim in self.children:
+            value = config.get(key, None)
+            if value is None:
+                continue
+
+            try:
+                claim.check(value)
+            except ClaimMismatch as e:
+                e.path.append(key)
+                raise
+
+
+class ListClaim:
+    __slots__ = ('item',)
+
+    def __init__(self, item):
+        self.item = item
+
+    def check(self, config):
+        if type(config) != list:
+            raise ClaimMismatch()
+
+        for i, value in enumerate(config):
+            try:
+                self.item.check(value)
+            except ClaimMismatch as e:
+                e.path.append(i)
+                raise
+
+
+class NomadClaimsMatcher:
+    """
+    nomad_claims compiled into the tree of the matcher nodes
+    """
+
+    def __init__(self, nomad_claims: dict):
+        self.root = NomadClaimsService.compile(nomad_claims)
+
+    def check(self, config):
+        if self.root is None:
+            return
+
+        try:
+            self.root.check(config)
+        except ClaimMismatch as e:
+            path = '.'.join(str(key) for key in reversed(e.path))
+            raise HTTPApiNomadClaimsCheckError(f'ROOT.{path}' if path else 'ROOT')
+
+
+class JwksEntry:
+    """
+    Cached JWKS document of a single jwks_url
+    """
+
+    def __init__(self, jwks: dict, ttl: float, etag=None, last_modified=None, validated_at=None):
+        self.jwks = jwks
+        self.kids = frozenset(jwk.get('kid') for jwk in jwks.get('keys', []))
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.time()
+        self.expires_at = self.fetched_at + ttl
+        # The last time the document has been confirmed by the IdP
+        self.validated_at = self.fetched_at if validated_at is None else validated_at
+        self.persisted = False
+
+    def is_fresh(self) -> bool:
+        return time.time() < self.expires_at
+
+    def is_usable(self) -> bool:
+        return time.time() - self.validated_at < settings.jwks_max_stale
+
+    def can_refresh(self) -> bool:
+        return time.time() - self.fetched_at >= settings.jwks_refresh_min_interval
+
+
+class ParsedToken:
+    """
+    JWT split and decoded (without verification) once, then passed through every stage of the run.
+    Built on the public PyJWT API (base64url_decode, exceptions), the private PyJWS._load changes between versions
+    """
+
+    def __init__(self, encoded: str):
+        if not isinstance(encoded, str):
+            raise jwt.DecodeError('Invalid token type. Token must be a string')
+
+        self.encoded = encoded
+        try:
+            self.signing_input, crypto_segment = encoded.encode('utf-8').rsplit(b'.', 1)
+            header_segment, payload_segment = self.signing_input.split(b'.', 1)
+        except ValueError:
+            raise jwt.DecodeError('Not enough segments')
+
+        self.header = ParsedToken.decode_segment(header_segment, 'header')
+        self.payload = ParsedToken.decode_segment(payload_segment, 'payload')
+        try:
+            self.signature = base64url_decode(crypto_segment)
+        except (TypeError, ValueError):
+            raise jwt.DecodeError('Invalid crypto padding')
+
+        self.issuer = self.payload.get('iss')
+        if self.issuer is not None and not isinstance(self.issuer, str):
+            raise jwt.InvalidTokenError('Issuer (iss) must be a string')
+        self.kid = self.header.get('kid')
+        if self.kid is not None and not isinstance(self.kid, str):
+            raise jwt.InvalidTokenError('Key ID header parameter must be a string')
+        self.digest = hashlib.sha256(encoded.encode()).digest()
+
+    @staticmethod
+    def decode_segment(segment: bytes, name: str) -> dict:
+        try:
+            data = json.loads(base64url_decode(segment).decode('utf-8'))
+        except (TypeError, ValueError) as e:
+            raise jwt.DecodeError(f'Invalid {name} string: {str(e)}')
+        if not isinstance(data, dict):
+            raise jwt.DecodeError(f'Invalid {name} string: must be a json object')
+
+        return data
+
+
+class RegisteredClaims:
+    """
+    Checks of the registered claims (iat, nbf, exp, aud) as jwt.decode of PyJWT 1.7 does with the default options:
+    no leeway, the token with "aud" is rejected as no audience is expected.
+    The private PyJWT._validate_claims changes its signature in PyJWT 2
+    """
+
+    @staticmethod
+    def get_int(payload: dict, claim: str, error):
+        try:
+            return int(payload[claim])
+        except (TypeError, ValueError):
+            raise error
+
+    @staticmethod
+    def validate(payload: dict, now: int = None):
+        now = int(time.time()) if now is None else now
+
+        if 'iat' in payload:
+            RegisteredClaims.get_int(payload, 'iat',
+                                     jwt.InvalidIssuedAtError('Issued At claim (iat) must be an integer.'))
+
+        if 'nbf' in payload:
+            nbf = RegisteredClaims.get_int(payload, 'nbf',
+                                           jwt.DecodeError('Not Before claim (nbf) must be an integer.'))
+            if nbf > now:
+                raise jwt.ImmatureSignatureError('The token is not yet valid (nbf)')
+
+        if 'exp' in payload:
+            exp = RegisteredClaims.get_int(payload, 'exp',
+                                           jwt.DecodeError('Expiration Time claim (exp) must be an integer.'))
+            if exp < now:
+                raise jwt.ExpiredSignatureError('Signature has expired')
+
+        if 'aud' in payload:
+            raise jwt.InvalidAudienceError('Invalid audience')
+
+
 class ConfigService:
+    jwks_cache = dict()
+    jwks_fetches = SingleFlight()
+    public_keys = dict()
+    verified_tokens = LruCache(settings.jwt_cache_size)
+    rs256 = jwt.algorithms.RSAAlgorithm(jwt.algorithms.RSAAlgorithm.SHA256)
+
     @staticmethod
     def get_issuer(encoded):
-        data = jwt.decode(encoded, verify=False)
-        return data.get('iss')
+        return ParsedToken(encoded).issuer
+
+    @staticmethod
+    def get_max_age(cache_control) -> int:
+        """
+        Obtains TTL from the Cache-Control header value
+        :return: TTL in seconds, 0 if the response must not be cached, settings default if not specified
+        """
+        directives = [value.strip().lower() for value in (cache_control or '').split(',')]
+        if 'no-store' in directives or 'no-cache' in directives:
+            return 0
+
+        for directive in directives:
+            if directive.startswith('max-age='):
+                try:
+                    return min(max(int(directive[len('max-age='):]), 0), settings.jwks_cache_max_ttl)
+                except ValueError:
+                    break
+
+        return settings.jwks_cache_ttl
 
     @staticmethod
-    async def get_jwks(url) -> dict:
-        async with aiohttp.ClientSession() as client:
-            async with client.get(url) as resp:
-                assert resp.status == 200
+    async def fetch_jwks(url, session: aiohttp.ClientSession = None, entry: JwksEntry = None) -> JwksEntry:
+        """
+        Downloads JWKS. If the cached entry is provided, the request is conditional
+        and the entry is revalidated on 304 Not Modified
+        """
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await ConfigService.fetch_jwks(url, session, entry)
+
+        headers = dict()
+        if entry is not None and entry.etag is not None:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified is not None:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            async with session.get(url, headers=headers) as resp:
+                ttl = ConfigService.get_max_age(resp.headers.get('Cache-Control'))
+                etag = resp.headers.get('ETag', None)
+                last_modified = resp.headers.get('Last-Modified', None)
+
+                if resp.status == 304 and entry is not None:
+                    return JwksEntry(entry.jwks, ttl, etag or entry.etag, last_modified or entry.last_modified)
+
+                if resp.status != 200:
+                    raise HTTPApiConfigServiceJwksError(url)
+
                 response = await resp.text()
-                keys = json.loads(response)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise HTTPApiConfigServiceJwksError(url)
 
-                return keys
+        try:
+            jwks = json.loads(response)
+        except ValueError:
+            raise HTTPApiConfigServiceJwksError(url)
+
+        if not ConfigService.is_jwks_valid(jwks):
+            raise HTTPApiConfigServiceJwksError(url)
+
+        return JwksEntry(jwks, ttl, etag, last_modified)
+
+    @staticmethod
+    def is_jwks_valid(jwks) -> bool:
+        """
+        Checks the document shape: {"keys": [{...}, ...]}
+        """
+        if not isinstance(jwks, dict) or not isinstance(jwks.get('keys', None), list):
+            return False
+        return all(isinstance(jwk, dict) for jwk in jwks['keys'])
+
+    @staticmethod
+    async def get_jwks(url, kid=None, session: aiohttp.ClientSession = None) -> dict:
+        """
+        Returns JWKS from the cache or downloads it if the cached one is expired.
+        If kid is provided and it is missing in the cached JWKS (key rotation), the JWKS is downloaded once again
+        :param session: Shared client session, a new one is created if not provided
+        """
+        entry: JwksEntry = ConfigService.jwks_cache.get(url, None)
+        if entry is not None and entry.is_fresh():
+            if kid is None or kid in entry.kids or not entry.can_refresh():
+                return entry.jwks
+
+        # Concurrent requests share the single download
+        entry = await ConfigService.jwks_fetches.run(url, ConfigService.refresh_jwks, url, session)
+        return entry.jwks
 
-    # https://renzolucioni.com/verifying-jwts-with-jwks-and-pyjwt/
     @staticmethod
-    def validate(encoded, jwks):
-        public_keys = dict()
-        for jwk in jwks['keys']:
-            kid = jwk['kid']
-            public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+    async def prefetch_jwks(url, horizon, session: aiohttp.ClientSession = None) -> bool:
+        """
+        Downloads JWKS if it is not cached or expires in less than horizon seconds
+        :return: True if the JWKS has been downloaded
+        """
+        entry: JwksEntry = ConfigService.jwks_cache.get(url, None)
+        if entry is not None and entry.expires_at - time.time() > horizon:
+            return False
+
+        await ConfigService.jwks_fetches.run(url, ConfigService.refresh_jwks, url, session)
+        return True
+
+    @staticmethod
+    async def refresh_jwks(url, session: aiohttp.ClientSession = None) -> JwksEntry:
+        """
+        Downloads JWKS into the cache. If the IdP is unavailable, the stale cached JWKS
+        is served (while it is not older than the allowed staleness) and retried later
+        """
+        entry: JwksEntry = ConfigService.jwks_cache.get(url, None)
+        try:
+            fresh = await ConfigService.fetch_jwks(url, session, entry)
+        except HTTPApiConfigServiceJwksError:
+            if entry is None or not entry.is_usable():
+                raise
 
-        kid = jwt.get_unverified_header(encoded)['kid']
-        key = public_keys[kid]
+            logging.warning(f'Failed to retrieve JWKS from {url}, using the stale one')
+            entry.fetched_at = time.time()
+            entry.expires_at = entry.fetched_at + settings.jwks_refresh_min_interval
+            return entry
+
+        ConfigService.jwks_cache[url] = fresh
+        return fresh
+
+    @staticmethod
+    def get_public_key(issuer, kid, jwks):
+        """
+        Returns the public key object for (issuer, kid) from the registry.
+        The key is built only if it is missing or its JWK has been changed in the JWKS
+        """
+        jwk = next((value for value in jwks['keys'] if value.get('kid') == kid), None)
+        if jwk is None:
+            raise HTTPApiConfigServiceJWTError(f'JWT Decode error: unknown kid "{kid}"')
+
+        registry = ConfigService.public_keys
+        registered = registry.get((issuer, kid), None)
+        if registered is not None and registered[0] == jwk:
+            return registered[1]
 
         try:
-            payload = jwt.decode(encoded, key=key, algorithms=['RS256'])
+            key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+        except PyJWTError as e:
+            raise HTTPApiConfigServiceJWTError(f'JWK error: {str(e)}')
+
+        # Registry is changed rarely, forget keys of the issuer which are not in the JWKS anymore
+        kids = set(value.get('kid') for value in jwks['keys'])
+        for registry_issuer, registry_kid in list(registry):
+            if registry_issuer == issuer and registry_kid not in kids:
+                registry.pop((registry_issuer, registry_kid), None)
+
+        registry[(issuer, kid)] = (dict(jwk), key)
+        return key
+
+    @staticmethod
+    def get_cached_payload(token: ParsedToken, jwks):
+        """
+        Returns the payload of the already verified token, None if the token has to be verified
+        """
+        verified = ConfigService.verified_tokens.get((token.issuer, token.digest), None)
+        if verified is None:
+            return None
+
+        # The token is trusted while its key is still published
+        if any(value.get('kid') == token.kid for value in jwks['keys']):
+            return verified
+
+        return None
+
+    @staticmethod
+    def remember_payload(token: ParsedToken, payload):
+        expires_at = payload.get('exp', None)
+        if type(expires_at) == int and expires_at > time.time():
+            ConfigService.verified_tokens.set((token.issuer, token.digest), payload, expires_at)
+
+    @staticmethod
+    def check_token(token: ParsedToken, key):
+        """
+        Checks the signature and the registered claims (exp, nbf, iat, aud) like jwt.decode does,
+        only the public PyJWT API is used
+        """
+        if token.header.get('alg') != 'RS256':
+            raise jwt.InvalidAlgorithmError('The specified alg value is not allowed')
+
+        if not ConfigService.rs256.verify(token.signing_input, key, token.signature):
+            raise jwt.InvalidSignatureError('Signature verification failed')
+
+        RegisteredClaims.validate(token.payload)
+
+    # https://renzolucioni.com/verifying-jwts-with-jwks-and-pyjwt/
+    @staticmethod
+    def verify(token: ParsedToken, jwks):
+        """
+        Verifies the token signature and claims, CPU-bound
+        """
+        key = ConfigService.get_public_key(token.issuer, token.kid, jwks)
+
+        try:
+            ConfigService.check_token(token, key)
         except PyJWTError as e:
             raise HTTPApiConfigServiceJWTError(f'JWT Decode error: {str(e)}')
 
+        return token.payload
+
+    @staticmethod
+    def validate(token, jwks):
+        if not isinstance(token, ParsedToken):
+            token = ParsedToken(token)
+
+        payload = ConfigService.get_cached_payload(token, jwks)
+        if payload is not None:
+            return payload
+
+        payload = ConfigService.verify(token, jwks)
+        ConfigService.remember_payload(token, payload)
         return payload
 
 
 class NomadService:
-    nomad_host = nomad.Nomad()
+    # Parsed jobs as JSON text by the Nomad version and the HCL sha256, optionally persisted in the directory
+    parsed_jobs = LruCache(settings.nomad_parse_cache_size)
+    parse_calls = SingleFlight()
+    # Files written since the directory has been pruned
+    parse_cache_writes = 0
+
+    @staticmethod
+    def get_parse_digest(version: Optional[str], hcl_job: str) -> str:
+        return hashlib.sha256(f'{version or ""}\n{hcl_job}'.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def get_parse_cache_path(digest: str) -> str:
+        return os.path.join(settings.nomad_parse_cache_dir, f'{digest}.json')
+
+    @staticmethod
+    def read_parse_cache_file(digest: str) -> Optional[str]:
+        path = NomadService.get_parse_cache_path(digest)
+        try:
+            with open(path, encoding='utf-8') as file:
+                text = file.read()
+            json.loads(text)
+
+            # The modification time orders the files for pruning
+            os.utime(path)
+            return text
+        except (OSError, ValueError):
+            return None
 
     @staticmethod
-    def transform(hcl_job) -> dict:
+    def write_parse_cache_file(digest: str, text: str):
+        path = NomadService.get_parse_cache_path(digest)
+        temp_path = f'{path}.{os.getpid()}.tmp'
         try:
-            return NomadService.nomad_host.jobs.parse(hcl_job)
-        except nomad.api.exceptions.BaseNomadException as e:
-            raise HTTPApiNomadServiceTransformException(
-                e.nomad_resp.text if hasattr(e.nomad_resp, "text") else str(e.nomad_resp))
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                file.write(text)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logging.warning(f'Failed to save the parsed job: {str(e)}')
 
     @staticmethod
-    def run(job_data: dict):
-        data = dict(Job=job_data)
+    def get_parse_cache_prune_interval() -> int:
+        """
+        The directory is scanned once per tenth of NOMAD_PARSE_CACHE_FILES writes, not on every miss,
+        so it may exceed the limit by that many files
+        """
+        return max(settings.nomad_parse_cache_files // 10, 1)
 
+    @staticmethod
+    def prune_parse_cache_dir():
+        """
+        Removes the least recently used files above NOMAD_PARSE_CACHE_FILES
+        """
+        files = []
+        try:
+            with os.scandir(settings.nomad_parse_cache_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json'):
+                        with suppress(OSError):
+                            files.append((entry.stat().st_mtime, entry.path))
+        except OSError as e:
+            logging.warning(f'Failed to prune the parsed jobs: {str(e)}')
+            return
+
+        files.sort()
+        for _, path in files[:max(len(files) - settings.nomad_parse_cache_files, 0)]:
+            with suppress(OSError):
+                os.remove(path)
+
+    @staticmethod
+    async def parse(client: NomadClient, hcl_job, digest: str, persist: bool) -> str:
+        loop = asyncio.get_event_loop()
+        if persist:
+            text = await loop.run_in_executor(None, NomadService.read_parse_cache_file, digest)
+            if text is not None:
+                return text
+
+        text = json.dumps(await client.parse(hcl_job))
+        if persist:
+            await loop.run_in_executor(None, NomadService.write_parse_cache_file, digest, text)
+
+            NomadService.parse_cache_writes += 1
+            if NomadService.parse_cache_writes >= NomadService.get_parse_cache_prune_interval():
+                NomadService.parse_cache_writes = 0
+                await loop.run_in_executor(None, NomadService.prune_parse_cache_dir)
+
+        return text
+
+    @staticmethod
+    async def transform(client: NomadClient, hcl_job) -> dict:
+        """
+        Parses HCL by Nomad, the result is cached by the Nomad version and the HCL hash.
+        The cache keeps the JSON text, every call gets its own copy of the job.
+        The directory is used only while the version is known, the parse output may change with it
+        """
+        version = client.version
+        digest = NomadService.get_parse_digest(version, hcl_job)
+        text = NomadService.parsed_jobs.get(digest, None)
+        if text is None:
+            persist = bool(settings.nomad_parse_cache_dir) and version is not None
+            try:
+                text = await NomadService.parse_calls.run(digest, NomadService.parse, client, hcl_job, digest, persist)
+            except NomadApiError as e:
+                raise HTTPApiNomadServiceTransformException(e.text)
+            except NomadUnavailableError as e:
+                raise HTTPApiNomadServiceUnavailable(str(e))
+
+            NomadService.parsed_jobs.set(digest, text)
+
+        return json.loads(text)
+
+    @staticmethod
+    async def run(client: NomadClient, job_data: dict):
         try:
             name = job_data['Name']
-            return NomadService.nomad_host.job.register_job(name, data)
-        except nomad.api.exceptions.BaseNomadException as e:
-            raise HTTPApiNomadServiceRunException(
-                e.nomad_resp.text if hasattr(e.nomad_resp, "text") else str(e.nomad_resp))
+            return await client.register(name, job_data)
+        except NomadApiError as e:
+            raise HTTPApiNomadServiceRunException(e.text)
+        except NomadUnavailableError as e:
+            raise HTTPApiNomadServiceUnavailable(str(e))
         except KeyError:
             raise HTTPApiNomadServiceRunException('Name key not found')
 
@@ -232,3 +757,82 @@ class ViewUtilities:
             raise HTTPApiInvalidJson()
 
         return data
+
+    @staticmethod
+    def get_etag(*values) -> str:
+        text = '\n'.join(str(value) for value in values)
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f'"{digest}"'
+
+    @staticmethod
+    def is_not_modified(request, etag: str) -> bool:
+        """
+        Checks If-None-Match against the ETag (weak comparison, as RFC 7232 requires for it)
+        """
+        if_none_match = request.headers.get('If-None-Match', None)
+        if if_none_match is None:
+            return False
+
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) == etag for tag in tags)
+
+    @staticmethod
+    def get_page_params(request) -> Tuple[int, int]:
+        try:
+            after = int(request.query.get('after', 0))
+        except ValueError:
+            raise HTTPApiPageDataInvalid('after')
+        if after < 0:
+            raise HTTPApiPageDataInvalid('after')
+
+        try:
+            limit = int(request.query.get('limit', settings.list_page_size))
+        except ValueError:
+            raise HTTPApiPageDataInvalid('limit')
+        if not 0 < limit <= settings.list_page_size:
+            raise HTTPApiPageDataInvalid('limit')
+
+        return after, limit
+
+    @staticmethod
+    async def list_response(request, get_page: Callable, transform: Callable):
+        """
+        Responds with the JSON list of the transformed rows, page by page (keyset on id).
+        The next page cursor is sent in the X-Next-After header.
+        With ?stream all the rows after the cursor are written in chunks, one page at a time
+        """
+        after, limit = ViewUtilities.get_page_params(request)
+        db = request.app['db']
+
+        if request.query.get('stream') is None:
+            async with db.connect() as conn:
+                result = await get_page(conn, after, limit)
+
+            response = web.json_response([transform(value) for value in result])
+            if len(result) == limit:
+                response.headers['X-Next-After'] = str(result[-1].id)
+            return response
+
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        response.enable_chunked_encoding()
+        await response.prepare(request)
+
+        await response.write(b'[')
+        separator = ''
+        while True:
+            # Connection is not held while the client reads
+            async with db.connect() as conn:
+                result = await get_page(conn, after, limit)
+
+            if result:
+                chunk = ','.join(json.dumps(transform(value)) for value in result)
+                await response.write(f'{separator}{chunk}'.encode('utf-8'))
+                separator = ','
+
+            if len(result) < limit:
+                break
+            after = result[-1].id
+
+        await response.write(b']')
+        await response.write_eof()
+        return response
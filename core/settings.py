@@ -1,8 +1,8 @@
 import os
 
 
-def get_env(key):
-    result = os.environ.get(key, None)
+def get_env(key, default=None):
+    result = os.environ.get(key, default)
     if result is None:
         raise RuntimeError(f'Environment variable "{key}" is unset')
 
@@ -13,5 +13,96 @@ connection_uri = get_env('SQLALCHEMY_URI')
 connection_params = dict(uri=get_env('SQLALCHEMY_URI'), echo=True)
 admin_token = get_env('ADMIN_TOKEN')
 
+# Database connection pool, the connection worker threads are kept with the pooled connections
+db_pool_size = int(get_env('DB_POOL_SIZE', '5'))
+db_max_overflow = int(get_env('DB_MAX_OVERFLOW', '10'))
+db_pool_timeout = float(get_env('DB_POOL_TIMEOUT', '30'))
+db_pool_recycle = int(get_env('DB_POOL_RECYCLE', '3600'))
+db_pool_pre_ping = get_env('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+db_pool_warm_up = int(get_env('DB_POOL_WARM_UP', '1'))
+
+# Role and config changes made by the other workers are polled from the change log
+change_poll_interval = float(get_env('CHANGE_POLL_INTERVAL', '1'))
+change_poll_batch = int(get_env('CHANGE_POLL_BATCH', '1000'))
+change_log_retention = float(get_env('CHANGE_LOG_RETENTION', '86400'))
+# Max. time (seconds) between the change log insert and its commit, the skipped ids are re-checked for it
+change_poll_window = float(get_env('CHANGE_POLL_WINDOW', '60'))
+
+# Role and config listings: default and max. page size (keyset pagination on id)
+list_page_size = int(get_env('LIST_PAGE_SIZE', '1000'))
+
+# Bulk role import: roles written in one transaction
+bulk_batch_size = int(get_env('BULK_BATCH_SIZE', '500'))
+
+# SQLite pragmas, set on every new connection. WAL lets the readers go on while the writer commits
+sqlite_journal_mode = get_env('SQLITE_JOURNAL_MODE', 'WAL').upper()
+sqlite_synchronous = get_env('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+sqlite_mmap_size = int(get_env('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+sqlite_cache_size = int(get_env('SQLITE_CACHE_SIZE', '-20000'))
+sqlite_busy_timeout = int(get_env('SQLITE_BUSY_TIMEOUT', '5000'))
+
+if sqlite_journal_mode not in ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'OFF'):
+    raise RuntimeError(f'Expected "sqlite_journal_mode" to be one of: WAL, DELETE, TRUNCATE, PERSIST, MEMORY, OFF')
+if sqlite_synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+    raise RuntimeError(f'Expected "sqlite_synchronous" to be one of: OFF, NORMAL, FULL, EXTRA')
+
 if len(admin_token) < 8:
     raise RuntimeError(f'Expected "admin_token" to be at least 8 char len')
+
+# JWKS cache: TTL is used when the IdP response has no Cache-Control max-age,
+# kid-miss refresh is not repeated more often than the given interval
+jwks_cache_ttl = int(get_env('JWKS_CACHE_TTL', '300'))
+jwks_cache_max_ttl = int(get_env('JWKS_CACHE_MAX_TTL', '86400'))
+jwks_refresh_min_interval = int(get_env('JWKS_REFRESH_MIN_INTERVAL', '10'))
+# Stale JWKS (the last one confirmed by the IdP) is used while the IdP is unavailable
+jwks_max_stale = int(get_env('JWKS_MAX_STALE', '86400'))
+
+# Background JWKS refresh: entries expiring before the next run (plus margin) are downloaded in advance
+jwks_refresh_interval = float(get_env('JWKS_REFRESH_INTERVAL', '60'))
+jwks_refresh_jitter = float(get_env('JWKS_REFRESH_JITTER', '0.1'))
+jwks_refresh_margin = float(get_env('JWKS_REFRESH_MARGIN', '30'))
+jwks_prefetch_timeout = float(get_env('JWKS_PREFETCH_TIMEOUT', '10'))
+
+# Verified JWT payloads are cached by the token digest until the token expires
+jwt_cache_size = int(get_env('JWT_CACHE_SIZE', '10000'))
+
+# Nomad API, the variables follow the Nomad CLI. TLS verification is skipped by default as python-nomad did
+# NOMAD_ADDR is a comma separated list of the Nomad servers
+nomad_addrs = [value.strip() for value in get_env('NOMAD_ADDR', 'http://127.0.0.1:4646').split(',') if value.strip()]
+nomad_token = get_env('NOMAD_TOKEN', '')
+nomad_namespace = get_env('NOMAD_NAMESPACE', '')
+nomad_region = get_env('NOMAD_REGION', '')
+nomad_timeout = float(get_env('NOMAD_TIMEOUT', '5'))
+nomad_cacert = get_env('NOMAD_CACERT', '')
+nomad_client_cert = get_env('NOMAD_CLIENT_CERT', '')
+nomad_client_key = get_env('NOMAD_CLIENT_KEY', '')
+nomad_skip_verify = get_env('NOMAD_SKIP_VERIFY', 'true').lower() in ('1', 'true', 'yes')
+# The server is skipped for the down interval after the failed calls, all of them are probed periodically
+nomad_max_failures = int(get_env('NOMAD_MAX_FAILURES', '1'))
+nomad_down_interval = float(get_env('NOMAD_DOWN_INTERVAL', '30'))
+nomad_health_interval = float(get_env('NOMAD_HEALTH_INTERVAL', '10'))
+nomad_health_timeout = float(get_env('NOMAD_HEALTH_TIMEOUT', '2'))
+
+if not nomad_addrs:
+    raise RuntimeError(f'Expected "nomad_addrs" to have at least one address')
+
+# Parsed job HCL cache (by the Nomad version and the HCL hash), the directory keeps it between restarts
+nomad_parse_cache_size = int(get_env('NOMAD_PARSE_CACHE_SIZE', '1000'))
+nomad_parse_cache_dir = get_env('NOMAD_PARSE_CACHE_DIR', '')
+nomad_parse_cache_files = int(get_env('NOMAD_PARSE_CACHE_FILES', '10000'))
+
+# CPU-bound stages (JWT verification, nomad_claims check) executor: "thread", "process" or "none" (event loop)
+cpu_executor = get_env('CPU_EXECUTOR', 'thread')
+cpu_executor_workers = int(get_env('CPU_EXECUTOR_WORKERS', str(os.cpu_count() or 1)))
+cpu_executor_queue = int(get_env('CPU_EXECUTOR_QUEUE', '100'))
+
+if cpu_executor not in ('thread', 'process', 'none'):
+    raise RuntimeError(f'Expected "cpu_executor" to be one of: thread, process, none')
+
+# Shared outbound HTTP client pool
+http_pool_limit = int(get_env('HTTP_POOL_LIMIT', '100'))
+http_pool_limit_per_host = int(get_env('HTTP_POOL_LIMIT_PER_HOST', '20'))
+http_keepalive_timeout = float(get_env('HTTP_KEEPALIVE_TIMEOUT', '30'))
+http_dns_cache_ttl = int(get_env('HTTP_DNS_CACHE_TTL', '300'))
+http_timeout = float(get_env('HTTP_TIMEOUT', '30'))
+http_connect_timeout = float(get_env('HTTP_CONNECT_TIMEOUT', '5'))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy import Column, Integer, String, Text, Float
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -11,6 +11,9 @@ class JwtRole(Base):
     role = Column(String(64), unique=True)
     bound_claims = Column(Text)
     nomad_claims = Column(Text)
+    # sha256 of the canonical bound_claims and nomad_claims, see CanonicalClaims
+    claims_hash = Column(String(64), index=True)
+    version = Column(Integer, nullable=False, server_default='1')
 
 
 class JwtConfig(Base):
@@ -18,4 +21,30 @@ class JwtConfig(Base):
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     jwks_url = Column(Text)
-    bound_issuer = Column(Text)
+    bound_issuer = Column(String(255), unique=True, index=True)
+
+
+class JwksSnapshot(Base):
+    __tablename__ = 'jwks_snapshot'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    jwks_url = Column(String(2048), unique=True)
+    jwks = Column(Text)
+    etag = Column(Text)
+    last_modified = Column(Text)
+    validated_at = Column(Float)
+
+
+class ChangeLog(Base):
+    """
+    Changed role and config keys, the workers poll it by the increasing id to reload their registries.
+    The ids are taken on insert, the transactions may commit in a different order.
+    SQLite must not reuse the ids of the pruned entries, the workers' cursors are ahead of them
+    """
+    __tablename__ = 'change_log'
+    __table_args__ = dict(sqlite_autoincrement=True)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    entity = Column(String(16), nullable=False)
+    key = Column(String(255), nullable=False)
+    created_at = Column(Float, nullable=False)
@@ -0,0 +1,45 @@
+import asyncio
+import time
+
+from core.cache import LruCache, SingleFlight
+
+
+def test_lru_cache_size():
+    cache = LruCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_lru_cache_expiration():
+    cache = LruCache(10)
+    cache.set('expired', 1, time.time() - 1)
+    cache.set('alive', 2, time.time() + 60)
+
+    assert cache.get('expired') is None
+    assert cache.get('alive') == 2
+    assert len(cache) == 1
+
+    assert cache.pop('alive') == 2
+    assert cache.pop('alive') is None
+
+
+async def test_single_flight():
+    async def call(value):
+        call.calls += 1
+        await asyncio.sleep(0.05)
+        return value
+
+    call.calls = 0
+
+    single_flight = SingleFlight()
+    results = await asyncio.gather(*[single_flight.run('key', call, i) for i in range(5)])
+    assert call.calls == 1
+    assert results == [0] * 5
+    assert single_flight.calls == dict()
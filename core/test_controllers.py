@@ -1,13 +1,19 @@
+import asyncio
 import json
+import time
 
 import cryptography.hazmat.backends
 import pytest
 from aiohttp.test_utils import TestClient
-from jwt import PyJWT
-from sqlalchemy import insert
+from sqlalchemy import insert, select
 
+from core import settings
 from core.app import create_app
-from core.tables import JwtRole, JwtConfig
+from core.repositories import ChangeLogRepository
+from core.scheduler import apply_changes
+from core.services import ConfigService, JwksEntry, CanonicalClaims, NomadService
+from core.exceptions import HTTPApiConfigServiceJwksError
+from core.tables import JwtRole, JwtConfig, JwksSnapshot, ChangeLog
 
 
 @pytest.fixture
@@ -21,7 +27,8 @@ async def jwt_role(db, nomad_validator):
 
 
 @pytest.fixture
-async def jwt_config(db):
+async def jwt_config(db, mock_fetch_jwks):
+    # The app prefetches JWKS of the configured issuers on startup
     async with db.connect() as conn:
         return await conn.execute(
             insert(JwtConfig).values(dict(jwks_url='https://gitlab.toliak.ru/-/jwks',
@@ -40,6 +47,15 @@ async def admin_headers(headers):
     return headers
 
 
+async def test_app_client_session(aiohttp_client):
+    client: TestClient = await aiohttp_client(create_app)
+    session = client.server.app['client_session']
+    assert session.closed is False
+
+    await client.close()
+    assert session.closed is True
+
+
 async def test_role_view_put_correct(aiohttp_client,
                                      prepare_db,
                                      admin_headers):
@@ -83,6 +99,92 @@ async def test_role_view_put_exists(aiohttp_client,
     assert '"76"' not in text
 
 
+async def test_role_view_put_version(aiohttp_client,
+                                     prepare_db,
+                                     db,
+                                     admin_headers):
+    """
+    Claims should be stored canonical, the version changes only with the claims
+    """
+
+    async def get_row():
+        async with db.connect() as conn:
+            row = await conn.execute(select([JwtRole]).where(JwtRole.role == 'role-test'))
+            return await row.fetchone()
+
+    client: TestClient = await aiohttp_client(create_app)
+    for bound_claims, version in [({"project_id": "1", "ref": "master"}, 1),
+                                  ({"ref": "master", "project_id": "1"}, 1),
+                                  ({"ref": "master", "project_id": "2"}, 2)]:
+        resp = await client.put('/role/role-test',
+                                headers=admin_headers,
+                                json=dict(bound_claims=bound_claims,
+                                          nomad_claims={"Name": "^test-service$"}))
+        assert resp.status == 200
+
+        result = await get_row()
+        assert result.version == version
+        assert result.bound_claims == CanonicalClaims.dumps(bound_claims)
+        assert result.claims_hash == CanonicalClaims(bound_claims, {"Name": "^test-service$"}).hash
+        assert client.server.app['roles'].get('role-test').version == version
+
+
+async def test_role_view_concurrent(aiohttp_client,
+                                    prepare_db,
+                                    db,
+                                    admin_headers):
+    """
+    Concurrent puts should all succeed, only one of the concurrent posts should
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    body = dict(bound_claims={"project_id": "1"}, nomad_claims={"Name": "^test-service$"})
+
+    responses = await asyncio.gather(*[client.put('/role/role-put', headers=admin_headers, json=body)
+                                       for _ in range(5)])
+    assert [resp.status for resp in responses] == [200] * 5
+    assert len(set([(await resp.json())['id'] for resp in responses])) == 1
+
+    responses = await asyncio.gather(*[client.post('/role/role-post', headers=admin_headers, json=body)
+                                       for _ in range(5)])
+    assert sorted(resp.status for resp in responses) == [200, 400, 400, 400, 400]
+
+    async with db.connect() as conn:
+        row = await conn.execute(select([JwtRole]))
+        assert sorted(value.role for value in await row.fetchall()) == ['role-post', 'role-put']
+
+
+async def test_role_view_registry(aiohttp_client,
+                                  prepare_db,
+                                  admin_headers,
+                                  jwt_role,
+                                  nomad_validator):
+    """
+    Role registry should be warmed up on startup and follow the changes
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    roles = client.server.app['roles']
+    assert roles.get('role-test').nomad_claims == nomad_validator
+
+    resp = await client.put('/role/role-test',
+                            headers=admin_headers,
+                            json=dict(bound_claims={"project_id": "22"},
+                                      nomad_claims={}))
+    assert resp.status == 200
+    assert roles.get('role-test').bound_claims == {"project_id": "22"}
+
+    resp = await client.post('/role/role-new',
+                             headers=admin_headers,
+                             json=dict(bound_claims={"project_id": "23"},
+                                       nomad_claims={}))
+    assert resp.status == 200
+    assert roles.get('role-new').id == json.loads(await resp.text())['id']
+
+    resp = await client.delete('/role/role-test',
+                               headers=admin_headers)
+    assert resp.status == 200
+    assert roles.get('role-test') is None
+
+
 async def test_role_view_put_wrong_data_bound(aiohttp_client,
                                               admin_headers,
                                               prepare_db):
@@ -119,6 +221,23 @@ async def test_role_view_put_wrong_data_nomad(aiohttp_client,
     assert 'nomad_claims' in text
 
 
+async def test_role_view_put_wrong_data_nomad_regex(aiohttp_client,
+                                                    admin_headers,
+                                                    prepare_db):
+    """
+    Should raise 400
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.put('/role/role-test',
+                            headers=admin_headers,
+                            json=dict(bound_claims={},
+                                      nomad_claims={"Name": "^test-(service$"}))
+    text = await resp.text()
+    assert resp.status == 400
+    assert 'nomad_claims' in text
+    assert 'ROOT.Name' in text
+
+
 async def test_role_view_put_wrong_token(aiohttp_client,
                                          admin_headers,
                                          prepare_db):
@@ -155,6 +274,65 @@ async def test_role_view_get_correct(aiohttp_client,
     assert '"id"' in text
 
 
+async def test_role_view_get_etag(aiohttp_client,
+                                  prepare_db,
+                                  admin_headers,
+                                  jwt_role,
+                                  nomad_validator):
+    """
+    Should return 304 while the role is not changed
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.get('/role/role-test',
+                            headers=admin_headers)
+    assert resp.status == 200
+    assert (await resp.json())['nomad_claims'] == nomad_validator
+    etag = resp.headers['ETag']
+
+    resp = await client.get('/role/role-test',
+                            headers=dict(admin_headers, **{'If-None-Match': f'"other", W/{etag}'}))
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+
+    resp = await client.put('/role/role-test',
+                            headers=admin_headers,
+                            json=dict(bound_claims={"project_id": "77"},
+                                      nomad_claims=nomad_validator))
+    assert resp.status == 200
+
+    resp = await client.get('/role/role-test',
+                            headers=dict(admin_headers, **{'If-None-Match': etag}))
+    assert resp.status == 200
+    assert resp.headers['ETag'] != etag
+    assert (await resp.json())['bound_claims'] == {"project_id": "77"}
+
+
+async def test_role_view_get_etag_registry(aiohttp_client,
+                                           prepare_db,
+                                           admin_headers,
+                                           nomad_validator,
+                                           mocker):
+    """
+    Should return 304 for the registered role without the database
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.put('/role/role-test',
+                            headers=admin_headers,
+                            json=dict(bound_claims={"project_id": "76"},
+                                      nomad_claims=nomad_validator))
+    assert resp.status == 200
+    resp = await client.get('/role/role-test',
+                            headers=admin_headers)
+    etag = resp.headers['ETag']
+
+    get_role = mocker.patch('core.repositories.RoleRepository.get')
+    resp = await client.get('/role/role-test',
+                            headers=dict(admin_headers, **{'If-None-Match': etag}))
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+    assert get_role.called is False
+
+
 async def test_role_view_get_wrong_token(aiohttp_client,
                                          prepare_db,
                                          admin_headers,
@@ -253,6 +431,42 @@ async def test_role_view_list_correct(aiohttp_client,
     assert '"role": "role-test"' in text
 
 
+async def test_role_view_list_pages(aiohttp_client,
+                                    prepare_db,
+                                    db,
+                                    admin_headers):
+    """
+    Should return the roles page by page, the stream should return all of them
+    """
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtRole), [dict(role=f'role-{i}', bound_claims='{}', nomad_claims='{}')
+                                             for i in range(5)])
+
+    client: TestClient = await aiohttp_client(create_app)
+    roles = []
+    after = 0
+    while after is not None:
+        resp = await client.get(f'/role/?list&limit=2&after={after}',
+                                headers=admin_headers)
+        assert resp.status == 200
+        page = await resp.json()
+        assert len(page) <= 2
+        roles += [value['role'] for value in page]
+        after = resp.headers.get('X-Next-After')
+    assert roles == [f'role-{i}' for i in range(5)]
+
+    resp = await client.get('/role/?list&limit=2&stream',
+                            headers=admin_headers)
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert [value['role'] for value in await resp.json()] == roles
+
+    resp = await client.get('/role/?list&limit=0',
+                            headers=admin_headers)
+    assert resp.status == 400
+    assert 'limit' in (await resp.json())['detail']
+
+
 async def test_role_view_list_wrong_token(aiohttp_client,
                                           prepare_db,
                                           admin_headers,
@@ -271,7 +485,8 @@ async def test_role_view_list_wrong_token(aiohttp_client,
     assert 'token' in text
 
 
-async def test_config_view_put_correct(aiohttp_client,
+async def test_config_view_put_correct(mock_fetch_jwks,
+                                       aiohttp_client,
                                        prepare_db,
                                        admin_headers):
     """
@@ -288,6 +503,118 @@ async def test_config_view_put_correct(aiohttp_client,
     assert '"id": 1' in text
 
 
+@pytest.fixture
+def mock_fetch_jwks(mocker, jwks_response):
+    """
+    Requested before aiohttp_client by the tests changing the configs:
+    the woken JWKS refresher may run on the app shutdown, the mock must be there yet
+    """
+    async def mock_function(url, session=None, entry=None):
+        mock_function.urls.append(url)
+        return JwksEntry(json.loads(jwks_response), 300)
+
+    mock_function.urls = []
+
+    mocker.patch.object(ConfigService, 'jwks_cache', dict())
+    mocker.patch('core.services.ConfigService.fetch_jwks', new=mock_function)
+    return mock_function
+
+
+async def test_app_jwks_prefetch(aiohttp_client,
+                                 prepare_db,
+                                 jwt_config,
+                                 mock_fetch_jwks):
+    """
+    JWKS of the configured issuers should be downloaded on startup
+    """
+    await aiohttp_client(create_app)
+    assert mock_fetch_jwks.urls == ['https://gitlab.toliak.ru/-/jwks']
+    assert 'https://gitlab.toliak.ru/-/jwks' in ConfigService.jwks_cache
+
+
+async def test_app_jwks_snapshot(aiohttp_client,
+                                 mocker,
+                                 prepare_db,
+                                 db,
+                                 jwt_config,
+                                 jwks_response,
+                                 mock_fetch_jwks):
+    """
+    Downloaded JWKS should be persisted and loaded on startup
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    await client.close()
+
+    async with db.connect() as conn:
+        row = await conn.execute(select([JwksSnapshot]))
+        result = await row.fetchall()
+
+    assert [value.jwks_url for value in result] == ['https://gitlab.toliak.ru/-/jwks']
+    assert json.loads(result[0].jwks) == json.loads(jwks_response)
+
+    # IdP is unavailable
+    async def mock_function(url, session=None, entry=None):
+        mock_function.entries.append(entry)
+        raise HTTPApiConfigServiceJwksError(url)
+
+    mock_function.entries = []
+
+    ConfigService.jwks_cache.clear()
+    mocker.patch('core.services.ConfigService.fetch_jwks', new=mock_function)
+    await aiohttp_client(create_app)
+
+    assert mock_function.entries[0].jwks == json.loads(jwks_response)
+    assert ConfigService.jwks_cache['https://gitlab.toliak.ru/-/jwks'].is_fresh() is True
+
+
+async def test_config_view_put_jwks_prefetch(mock_fetch_jwks,
+                                             aiohttp_client,
+                                             prepare_db,
+                                             admin_headers):
+    """
+    JWKS of the new issuer should be downloaded in background
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.put('/config/',
+                            headers=admin_headers,
+                            json=dict(jwks_url='https://gitlab.com/-/jwks',
+                                      bound_issuer='gitlab.com'))
+    assert resp.status == 200
+
+    for _ in range(100):
+        if mock_fetch_jwks.urls:
+            break
+        await asyncio.sleep(0.01)
+
+    assert mock_fetch_jwks.urls == ['https://gitlab.com/-/jwks']
+
+
+async def test_config_view_registry(mock_fetch_jwks,
+                                    aiohttp_client,
+                                    prepare_db,
+                                    admin_headers,
+                                    jwt_config):
+    """
+    Issuer registry should be warmed up on startup and follow the changes
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    issuers = client.server.app['issuers']
+    assert issuers.get('gitlab.toliak.ru').jwks_url == 'https://gitlab.toliak.ru/-/jwks'
+
+    resp = await client.put('/config/',
+                            headers=admin_headers,
+                            json=dict(jwks_url='https://gitlab.com/-/jwks',
+                                      bound_issuer='gitlab.com'))
+    assert resp.status == 200
+    assert issuers.get('gitlab.com').id == json.loads(await resp.text())['id']
+
+    resp = await client.delete('/config/',
+                               headers=admin_headers,
+                               json=dict(bound_issuer='gitlab.toliak.ru'))
+    assert resp.status == 200
+    assert issuers.get('gitlab.toliak.ru') is None
+
+
 async def test_config_view_put_exists(aiohttp_client,
                                       prepare_db,
                                       admin_headers,
@@ -306,6 +633,29 @@ async def test_config_view_put_exists(aiohttp_client,
     assert 'exist' in text
 
 
+async def test_config_view_put_concurrent(mock_fetch_jwks,
+                                          aiohttp_client,
+                                          prepare_db,
+                                          db,
+                                          admin_headers):
+    """
+    Only one of the concurrent puts should create the config
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    responses = await asyncio.gather(*[
+        client.put('/config/',
+                   headers=admin_headers,
+                   json=dict(jwks_url='https://gitlab.toliak.ru/-/jwks',
+                             bound_issuer='gitlab.toliak.ru'))
+        for _ in range(5)
+    ])
+    assert sorted(resp.status for resp in responses) == [200, 400, 400, 400, 400]
+
+    async with db.connect() as conn:
+        row = await conn.execute(select([JwtConfig]).where(JwtConfig.bound_issuer == 'gitlab.toliak.ru'))
+        assert len(await row.fetchall()) == 1
+
+
 async def test_config_view_put_wrong_data_jwks(aiohttp_client,
                                                admin_headers,
                                                prepare_db):
@@ -376,6 +726,50 @@ async def test_config_view_get_correct(aiohttp_client,
     assert '"id"' in text
 
 
+async def test_config_view_get_etag(aiohttp_client,
+                                    prepare_db,
+                                    admin_headers,
+                                    jwt_config,
+                                    mock_fetch_jwks):
+    """
+    Should return 304 while the config is not changed
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.get('/config/?bound_issuer=gitlab.toliak.ru',
+                            headers=admin_headers)
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+
+    resp = await client.get('/config/?bound_issuer=gitlab.toliak.ru',
+                            headers=dict(admin_headers, **{'If-None-Match': etag}))
+    assert resp.status == 304
+
+    resp = await client.get('/config/?bound_issuer=gitlab.toliak.ru',
+                            headers=dict(admin_headers, **{'If-None-Match': '"other"'}))
+    assert resp.status == 200
+
+
+async def test_config_view_get_etag_registry(aiohttp_client,
+                                             prepare_db,
+                                             admin_headers,
+                                             jwt_config,
+                                             mock_fetch_jwks,
+                                             mocker):
+    """
+    Should return 304 for the registered config without the database
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.get('/config/?bound_issuer=gitlab.toliak.ru',
+                            headers=admin_headers)
+    etag = resp.headers['ETag']
+
+    get_config = mocker.patch('core.repositories.ConfigRepository.get')
+    resp = await client.get('/config/?bound_issuer=gitlab.toliak.ru',
+                            headers=dict(admin_headers, **{'If-None-Match': etag}))
+    assert resp.status == 304
+    assert get_config.called is False
+
+
 async def test_config_view_get_wrong_token(aiohttp_client,
                                            prepare_db,
                                            admin_headers,
@@ -509,6 +903,35 @@ async def test_config_view_list_correct(aiohttp_client,
     assert '"bound_issuer": "gitlab.toliak.ru"' in text
 
 
+async def test_config_view_list_pages(aiohttp_client,
+                                      prepare_db,
+                                      db,
+                                      admin_headers,
+                                      mock_fetch_jwks):
+    """
+    Should return the configs after the cursor
+    """
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtConfig), [dict(jwks_url='https://gitlab.toliak.ru/-/jwks',
+                                                    bound_issuer=f'issuer-{i}') for i in range(3)])
+
+    client: TestClient = await aiohttp_client(create_app)
+    resp = await client.get('/config/?list&limit=2',
+                            headers=admin_headers)
+    assert resp.status == 200
+    page = await resp.json()
+    assert [value['bound_issuer'] for value in page] == ['issuer-0', 'issuer-1']
+
+    resp = await client.get(f'/config/?list&stream&after={resp.headers["X-Next-After"]}',
+                            headers=admin_headers)
+    assert resp.status == 200
+    assert [value['bound_issuer'] for value in await resp.json()] == ['issuer-2']
+
+    resp = await client.get('/config/?list&after=first',
+                            headers=admin_headers)
+    assert resp.status == 400
+
+
 async def test_config_view_list_wrong_token(aiohttp_client,
                                             prepare_db,
                                             admin_headers,
@@ -529,32 +952,28 @@ async def test_config_view_list_wrong_token(aiohttp_client,
 
 @pytest.fixture
 def run_view_post_mock_everything(mocker,
+                                  mock_fetch_jwks,
                                   nomad_hcl_job,
                                   ci_job_jwt,
                                   jwks_response,
                                   ci_job_jwt_body,
                                   nomad_config_json):
-    async def mock_get_jwks(jwks_url):
+    async def mock_get_jwks(jwks_url, kid=None, session=None):
         assert jwks_url == 'https://gitlab.toliak.ru/-/jwks'
         mock_get_jwks.called = True
         return json.loads(jwks_response)
 
     mock_get_jwks.called = False
 
-    def mock_jwt_decode(encoded, key=None, algorithms=None, verify=True):
-        if verify is True:
-            assert type(algorithms) == list
-            assert isinstance(key, cryptography.hazmat.backends.openssl.rsa._RSAPublicKey)
-            assert encoded == ci_job_jwt
-            mock_jwt_decode.called = True
-
-            return json.loads(ci_job_jwt_body)
+    def mock_check_token(token, key):
+        assert isinstance(key, cryptography.hazmat.backends.openssl.rsa._RSAPublicKey)
+        assert token.encoded == ci_job_jwt
+        assert token.payload['project_id'] == json.loads(ci_job_jwt_body)['project_id']
+        mock_check_token.called = True
 
-        return PyJWT().decode(encoded, verify=False)
+    mock_check_token.called = False
 
-    mock_jwt_decode.called = False
-
-    def mock_nomad_transform(hcl):
+    async def mock_nomad_transform(this, hcl):
         assert hcl == nomad_hcl_job
         mock_nomad_transform.called = True
 
@@ -562,7 +981,7 @@ def run_view_post_mock_everything(mocker,
 
     mock_nomad_transform.called = False
 
-    def mock_nomad_register_job(this, uid, job):
+    async def mock_nomad_register_job(this, uid, job):
         assert uid == 'test-deployer'
         assert type(job) == dict
         mock_nomad_register_job.called = True
@@ -572,12 +991,13 @@ def run_view_post_mock_everything(mocker,
     mock_nomad_register_job.called = False
 
     mocker.patch('core.services.ConfigService.get_jwks', new=mock_get_jwks)
-    mocker.patch('jwt.decode', new=mock_jwt_decode)
-    mocker.patch('core.services.NomadService.transform', new=mock_nomad_transform)
-    mocker.patch('nomad.api.job.Job.register_job', new=mock_nomad_register_job)
+    mocker.patch('core.services.ConfigService.check_token', new=mock_check_token)
+    NomadService.parsed_jobs.clear()
+    mocker.patch('core.nomad_client.NomadClient.parse', new=mock_nomad_transform)
+    mocker.patch('core.nomad_client.NomadClient.register', new=mock_nomad_register_job)
 
     return [mock_get_jwks,
-            mock_jwt_decode,
+            mock_check_token,
             mock_nomad_transform,
             mock_nomad_register_job, ]
 
@@ -595,7 +1015,7 @@ async def test_run_view_post_correct(aiohttp_client,
     Should return 200
     """
     [mock_get_jwks,
-     mock_jwt_decode,
+     mock_check_token,
      mock_nomad_transform,
      mock_nomad_register_job, ] = run_view_post_mock_everything
 
@@ -610,11 +1030,40 @@ async def test_run_view_post_correct(aiohttp_client,
     assert '"success": true' in text
 
     assert mock_get_jwks.called is True
-    assert mock_jwt_decode.called is True
+    assert mock_check_token.called is True
     assert mock_nomad_transform.called is True
     assert mock_nomad_register_job.called is True
 
 
+async def test_run_view_post_role_created_elsewhere(aiohttp_client,
+                                                    prepare_db,
+                                                    headers,
+                                                    jwt_config,
+                                                    nomad_validator,
+                                                    nomad_hcl_job,
+                                                    ci_job_jwt,
+                                                    db,
+                                                    run_view_post_mock_everything):
+    """
+    Role missing in the registry should be loaded from the database
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    assert client.server.app['roles'].get('role-test') is None
+
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtRole).values(dict(role='role-test',
+                                                       bound_claims='{"project_id":"76"}',
+                                                       nomad_claims=json.dumps(nomad_validator))))
+
+    response = await client.post('/run/',
+                                 headers=headers,
+                                 json=dict(job_hcl=nomad_hcl_job,
+                                           role='role-test',
+                                           jwt=ci_job_jwt))
+    assert response.status == 200
+    assert client.server.app['roles'].get('role-test') is not None
+
+
 async def test_run_view_post_fail_no_jwt(aiohttp_client,
                                          prepare_db,
                                          headers,
@@ -657,3 +1106,189 @@ async def test_run_view_post_fail_no_data(aiohttp_client,
     assert response.status == 400
     text = await response.text()
     assert 'invalid' in text
+
+
+async def test_bulk_role_view_import_export(aiohttp_client,
+                                            prepare_db,
+                                            db,
+                                            nomad_validator,
+                                            mocker):
+    """
+    Imported roles should be created, updated or left unchanged and exported back
+    """
+    mocker.patch('core.settings.bulk_batch_size', 2)
+    client: TestClient = await aiohttp_client(create_app)
+    headers = {'Authorization': 'Bearer admin_token_test', 'Content-Type': 'application/x-ndjson'}
+
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtRole).values(dict(role='role-0',
+                                                       bound_claims='{"project_id":"0"}',
+                                                       nomad_claims='{"Name":"^test$"}')))
+    lines = [json.dumps(dict(role=f'role-{i}',
+                             bound_claims=dict(project_id=str(i)),
+                             nomad_claims=nomad_validator)) for i in range(5)]
+    resp = await client.put('/bulk/role/', headers=headers, data='\n'.join(lines) + '\n')
+    assert resp.status == 200
+    assert await resp.json() == dict(created=4, updated=1, unchanged=0)
+
+    resp = await client.put('/bulk/role/', headers=headers, data='\n'.join(lines))
+    assert await resp.json() == dict(created=0, updated=0, unchanged=5)
+
+    roles = client.server.app['roles']
+    assert roles.get('role-0').version == 2
+    assert roles.get('role-4').nomad_claims == nomad_validator
+
+    resp = await client.get('/bulk/role/', headers=headers)
+    assert resp.status == 200
+    assert resp.headers['Content-Type'] == 'application/x-ndjson'
+    exported = [json.loads(line) for line in (await resp.text()).splitlines()]
+    assert exported == [json.loads(line) for line in lines]
+
+
+async def test_bulk_role_view_import_invalid(aiohttp_client,
+                                             prepare_db,
+                                             nomad_validator):
+    """
+    Should raise 400 with the invalid line number
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    headers = {'Authorization': 'Bearer admin_token_test', 'Content-Type': 'application/x-ndjson'}
+
+    lines = [json.dumps(dict(role='role-0', bound_claims=dict(), nomad_claims=nomad_validator)),
+             json.dumps(dict(role='role-1', bound_claims=dict(), nomad_claims=dict(Name='^(test$'))),
+             '{']
+    resp = await client.put('/bulk/role/', headers=headers, data='\n'.join(lines))
+    assert resp.status == 400
+    assert 'line 2' in (await resp.json())['detail']
+
+    resp = await client.put('/bulk/role/', headers=headers, data='\n'.join([lines[0], lines[2]]))
+    assert resp.status == 400
+    assert 'line 2' in (await resp.json())['detail']
+
+    headers['Authorization'] = 'Bearer wrong-token'
+    resp = await client.get('/bulk/role/', headers=headers)
+    assert resp.status == 401
+
+
+async def test_change_log_workers(mock_fetch_jwks,
+                                  aiohttp_client,
+                                  prepare_db,
+                                  admin_headers,
+                                  nomad_validator):
+    """
+    Changes made by one worker should be applied by another one from the change log
+    """
+    first: TestClient = await aiohttp_client(create_app)
+    second: TestClient = await aiohttp_client(create_app)
+    roles = second.server.app['roles']
+    issuers = second.server.app['issuers']
+
+    resp = await first.put('/role/role-test',
+                           headers=admin_headers,
+                           json=dict(bound_claims={"project_id": "76"},
+                                     nomad_claims=nomad_validator))
+    assert resp.status == 200
+    resp = await first.put('/config/',
+                           headers=admin_headers,
+                           json=dict(jwks_url='https://gitlab.toliak.ru/-/jwks',
+                                     bound_issuer='gitlab.toliak.ru'))
+    assert resp.status == 200
+    assert roles.get('role-test') is None
+
+    assert await apply_changes(second.server.app) == 2
+    assert roles.get('role-test').bound_claims == {"project_id": "76"}
+    assert issuers.get('gitlab.toliak.ru').jwks_url == 'https://gitlab.toliak.ru/-/jwks'
+    assert await apply_changes(second.server.app) == 0
+
+    resp = await first.put('/role/role-test',
+                           headers=admin_headers,
+                           json=dict(bound_claims={"project_id": "77"},
+                                     nomad_claims=nomad_validator))
+    assert resp.status == 200
+    resp = await first.delete('/config/',
+                              headers=admin_headers,
+                              json=dict(bound_issuer='gitlab.toliak.ru'))
+    assert resp.status == 200
+
+    assert await apply_changes(second.server.app) == 2
+    assert roles.get('role-test').bound_claims == {"project_id": "77"}
+    assert roles.get('role-test').version == 2
+    assert issuers.get('gitlab.toliak.ru') is None
+
+    resp = await first.delete('/role/role-test',
+                              headers=admin_headers)
+    assert resp.status == 200
+    assert await apply_changes(second.server.app) == 1
+    assert roles.get('role-test') is None
+
+
+async def test_change_log_commit_order(aiohttp_client,
+                                       prepare_db,
+                                       db,
+                                       nomad_validator):
+    """
+    The entry committed after the entry with a greater id should be applied too
+    """
+    client: TestClient = await aiohttp_client(create_app)
+    app = client.server.app
+    roles = app['roles']
+
+    async def commit_role(change_id, role):
+        async with db.connect() as conn:
+            await conn.execute(insert(JwtRole).values(dict(role=role,
+                                                           bound_claims='{}',
+                                                           nomad_claims=json.dumps(nomad_validator))))
+            await conn.execute(insert(ChangeLog).values(dict(id=change_id,
+                                                             entity=ChangeLogRepository.ROLE,
+                                                             key=role,
+                                                             created_at=time.time())))
+
+    # The slow transaction has got the id 1, the id 2 is committed first
+    await commit_role(2, 'role-fast')
+    assert await apply_changes(app) == 1
+    assert roles.get('role-fast') is not None
+    assert app['change_log_gaps'].keys() == {1}
+
+    await commit_role(1, 'role-slow')
+    assert await apply_changes(app) == 1
+    assert roles.get('role-slow') is not None
+    assert app['change_log_gaps'] == {}
+    assert await apply_changes(app) == 0
+
+    # The rolled back id is re-checked within the window only
+    await commit_role(4, 'role-next')
+    assert await apply_changes(app) == 1
+    app['change_log_gaps'][3] -= settings.change_poll_window + 1
+    assert await apply_changes(app) == 0
+    assert app['change_log_gaps'] == {}
+
+
+async def test_change_log_pruned(aiohttp_client,
+                                 prepare_db,
+                                 db,
+                                 admin_headers,
+                                 nomad_validator):
+    """
+    The change made after every entry has been pruned should be applied, the ids are not reused
+    """
+    first: TestClient = await aiohttp_client(create_app)
+    second: TestClient = await aiohttp_client(create_app)
+    app = second.server.app
+
+    async def put_role(project_id):
+        resp = await first.put('/role/role-test',
+                               headers=admin_headers,
+                               json=dict(bound_claims={"project_id": project_id},
+                                         nomad_claims=nomad_validator))
+        assert resp.status == 200
+
+    await put_role('76')
+    assert await apply_changes(app) == 1
+
+    async with db.connect() as conn:
+        await ChangeLogRepository.delete_before(conn, time.time() + 1)
+        assert await ChangeLogRepository.get_last_id(conn) == 0
+
+    await put_role('77')
+    assert await apply_changes(app) == 1
+    assert app['roles'].get('role-test').bound_claims == {"project_id": "77"}
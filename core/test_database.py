@@ -0,0 +1,81 @@
+import threading
+
+from sqlalchemy.pool import QueuePool
+
+from core import settings
+from core.database import create_db_engine, get_engine_options, warm_up_db
+
+
+def test_engine_options():
+    options = get_engine_options('sqlite:////tmp/db.sqlite')
+    assert options['poolclass'] is QueuePool
+    assert options['pool_size'] == settings.db_pool_size
+    assert options['idle_workers'] == settings.db_pool_size + settings.db_max_overflow
+
+    options = get_engine_options('sqlite://')
+    assert 'pool_size' not in options
+
+    options = get_engine_options('postgresql://user@localhost/deployer')
+    assert 'poolclass' not in options
+    assert options['max_overflow'] == settings.db_max_overflow
+
+
+async def test_engine_reuses_workers(loop):
+    engine = create_db_engine()
+    try:
+        async with engine.connect() as conn:
+            assert await conn.scalar('SELECT 1') == 1
+
+        threads = threading.active_count()
+        for _ in range(5):
+            async with engine.connect() as conn:
+                assert await conn.scalar('SELECT 1') == 1
+
+        assert threading.active_count() == threads
+        assert len(engine.parked_workers) == 1
+    finally:
+        await engine.stop_workers()
+        engine.sync_engine.dispose()
+
+
+async def test_engine_warm_up(loop):
+    engine = create_db_engine()
+    try:
+        await warm_up_db(engine, 3)
+        assert len(engine.parked_workers) == 3
+        assert engine.sync_engine.pool.checkedin() == 3
+    finally:
+        await engine.stop_workers()
+        engine.sync_engine.dispose()
+
+    assert engine.parked_workers == []
+
+
+async def test_engine_sqlite_pragmas(loop):
+    engine = create_db_engine()
+    try:
+        async with engine.connect() as conn:
+            assert (await conn.scalar('PRAGMA journal_mode')).upper() == settings.sqlite_journal_mode
+            assert await conn.scalar('PRAGMA busy_timeout') == settings.sqlite_busy_timeout
+            assert await conn.scalar('PRAGMA cache_size') == settings.sqlite_cache_size
+            assert await conn.scalar('PRAGMA synchronous') == 1  # NORMAL
+    finally:
+        await engine.stop_workers()
+        engine.sync_engine.dispose()
+
+
+async def test_engine_sqlite_reader_not_blocked(loop, prepare_db):
+    engine = create_db_engine()
+    try:
+        async with engine.connect() as writer, engine.connect() as reader:
+            transaction = await writer.begin()
+            await writer.execute("INSERT INTO jwt_config (jwks_url, bound_issuer) VALUES ('url', 'issuer')")
+
+            # The uncommitted write is not visible, the reader is not blocked
+            assert await reader.scalar('SELECT COUNT(*) FROM jwt_config') == 0
+
+            await transaction.commit()
+            assert await reader.scalar('SELECT COUNT(*) FROM jwt_config') == 1
+    finally:
+        await engine.stop_workers()
+        engine.sync_engine.dispose()
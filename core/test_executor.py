@@ -0,0 +1,39 @@
+import pytest
+
+from core.exceptions import HTTPApiExecutorBusy, HTTPApiNomadClaimsCheckError
+from core.executor import init_executor, close_executor, run_cpu_bound
+from core.services import NomadClaimsService
+
+
+@pytest.fixture(params=['thread', 'process', 'none'])
+async def executor_app(loop, mocker, request):
+    mocker.patch('core.settings.cpu_executor', new=request.param)
+    app = dict()
+    await init_executor(app)
+    yield app
+    await close_executor(app)
+
+
+async def test_run_cpu_bound(executor_app, nomad_config_json, nomad_validator):
+    assert await run_cpu_bound(executor_app,
+                               NomadClaimsService.check_nomad_config, nomad_config_json, nomad_validator) is True
+    assert executor_app['executor_pending'] == 0
+
+
+async def test_run_cpu_bound_exception(executor_app, nomad_config_json):
+    with pytest.raises(HTTPApiNomadClaimsCheckError) as e:
+        await run_cpu_bound(executor_app,
+                            NomadClaimsService.check_nomad_config, nomad_config_json, dict(Name='^gitl$'))
+
+    assert e.value.reason == 'Nomad check error at key: ROOT.Name'
+    assert e.value.status == 400
+
+
+async def test_run_cpu_bound_busy(mocker, executor_app, nomad_config_json, nomad_validator):
+    if executor_app['executor'] is None:
+        return
+
+    mocker.patch('core.settings.cpu_executor_queue', new=0)
+    with pytest.raises(HTTPApiExecutorBusy):
+        await run_cpu_bound(executor_app,
+                            NomadClaimsService.check_nomad_config, nomad_config_json, nomad_validator)
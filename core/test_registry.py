@@ -0,0 +1,51 @@
+import json
+
+from core.registry import RoleRegistry, IssuerRegistry
+
+
+class Row:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def test_role_registry(nomad_validator):
+    registry = RoleRegistry()
+    entry = registry.set_row(Row(id=1,
+                                 role='role-test',
+                                 bound_claims='{"project_id":"76"}',
+                                 nomad_claims=json.dumps(nomad_validator),
+                                 claims_hash='hash',
+                                 version=1))
+
+    assert registry.get('role-test') is entry
+    assert entry.bound_claims == dict(project_id='76')
+    assert entry.nomad_claims == nomad_validator
+
+    # Same hash, claims are not decoded again
+    assert registry.set_row(Row(id=1, role='role-test', bound_claims=None, nomad_claims=None,
+                                claims_hash='hash', version=2)) is entry
+    assert entry.version == 2
+
+    registry.set(1, 'role-test', dict(project_id='77'), dict())
+    assert registry.get('role-test').bound_claims == dict(project_id='77')
+
+    registry.remove('role-test')
+    registry.remove('role-test')
+    assert registry.get('role-test') is None
+    assert len(registry) == 0
+
+
+def test_issuer_registry():
+    registry = IssuerRegistry()
+    entry = registry.set_row(Row(id=1,
+                                 bound_issuer='gitlab.toliak.ru',
+                                 jwks_url='https://gitlab.toliak.ru/-/jwks'))
+    registry.set(2, 'gitlab.com', 'https://gitlab.com/-/jwks')
+
+    assert registry.get('gitlab.toliak.ru') is entry
+    assert entry.jwks_url == 'https://gitlab.toliak.ru/-/jwks'
+    assert sorted(value.id for value in registry) == [1, 2]
+
+    registry.remove('gitlab.com')
+    assert registry.get('gitlab.com') is None
+    assert len(registry) == 1
@@ -0,0 +1,125 @@
+import json
+
+import pytest
+from sqlalchemy import insert
+
+from core.repositories import RunRepository, RoleRepository, ConfigRepository
+from core.tables import JwtRole, JwtConfig
+
+
+async def insert_config(db):
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtConfig).values(dict(jwks_url='https://gitlab.toliak.ru/-/jwks',
+                                                         bound_issuer='gitlab.toliak.ru')))
+
+
+async def insert_role(db, nomad_validator):
+    async with db.connect() as conn:
+        await conn.execute(insert(JwtRole).values(dict(role='role-test',
+                                                       bound_claims='{"project_id":"76"}',
+                                                       nomad_claims=json.dumps(nomad_validator))))
+
+
+async def test_run_repository_config_and_role(loop, prepare_db, db, nomad_validator):
+    await insert_config(db)
+    await insert_role(db, nomad_validator)
+
+    async with db.connect() as conn:
+        config, role = await RunRepository.get_config_and_role(conn, 'gitlab.toliak.ru', 'role-test')
+        assert config.bound_issuer == 'gitlab.toliak.ru'
+        assert config.jwks_url == 'https://gitlab.toliak.ru/-/jwks'
+        assert role.role == 'role-test'
+        assert json.loads(role.nomad_claims) == nomad_validator
+        assert role.version == 1
+
+        config, role = await RunRepository.get_config_and_role(conn, 'gitlab.toliak.ru', 'role-not-exists')
+        assert config.bound_issuer == 'gitlab.toliak.ru'
+        assert role is None
+
+        config, role = await RunRepository.get_config_and_role(conn, 'not-exists', 'role-test')
+        assert config is None
+        assert role is None
+
+
+async def test_run_repository_partial(loop, prepare_db, db, nomad_validator):
+    await insert_config(db)
+    await insert_role(db, nomad_validator)
+
+    async with db.connect() as conn:
+        config, role = await RunRepository.get_config_and_role(conn, None, 'role-test')
+        assert config is None
+        assert role.role == 'role-test'
+
+        config, role = await RunRepository.get_config_and_role(conn, 'gitlab.toliak.ru', None)
+        assert config.bound_issuer == 'gitlab.toliak.ru'
+        assert role is None
+
+
+async def test_role_repository_upsert(loop, prepare_db, db):
+    values = dict(role='role-test', bound_claims='{}', nomad_claims='{}', claims_hash='hash')
+
+    async with db.connect() as conn:
+        role_id, version = await RoleRepository.upsert(conn, values)
+        assert version == 1
+
+        assert await RoleRepository.upsert(conn, values) == (role_id, 1)
+        assert await RoleRepository.upsert(conn, dict(values, claims_hash='other')) == (role_id, 2)
+
+        row = await RoleRepository.get(conn, 'role-test')
+        assert row.claims_hash == 'other'
+        assert row.version == 2
+
+
+@pytest.mark.parametrize('sqlite_version', [(3, 16, 2), (3, 31, 1)])
+async def test_role_repository_upsert_old_sqlite(loop, prepare_db, db, mocker, sqlite_version):
+    """
+    SQLite before 3.24 has no upsert, before 3.35 has no RETURNING
+    """
+    mocker.patch('sqlite3.dbapi2.sqlite_version_info', sqlite_version)
+    values = dict(role='role-test', bound_claims='{}', nomad_claims='{}', claims_hash='hash')
+
+    async with db.connect() as conn:
+        role_id, version = await RoleRepository.upsert(conn, values)
+        assert version == 1
+
+        assert await RoleRepository.upsert(conn, values) == (role_id, 1)
+        assert await RoleRepository.upsert(conn, dict(values, claims_hash='other')) == (role_id, 2)
+        assert len(await RoleRepository.get_all(conn)) == 1
+
+
+@pytest.mark.parametrize('sqlite_version', [(3, 16, 2), (3, 40, 1)])
+async def test_role_repository_save_many_concurrent(loop, prepare_db, db, mocker, nomad_validator, sqlite_version):
+    """
+    The role created after the existing roles are selected should be updated, not fail the batch
+    """
+    mocker.patch('sqlite3.dbapi2.sqlite_version_info', sqlite_version)
+    await insert_role(db, nomad_validator)
+
+    async def get_many(conn, roles):
+        return []
+
+    mocker.patch.object(RoleRepository, 'get_many', new=get_many)
+    values = [dict(role=role, bound_claims='{}', nomad_claims='{}', claims_hash='hash')
+              for role in ('role-test', 'role-new')]
+
+    async with db.connect() as conn:
+        assert await RoleRepository.save_many(conn, values) == (['role-test', 'role-new'], [])
+
+        row = await RoleRepository.get(conn, 'role-test')
+        assert row.claims_hash == 'hash'
+        assert row.version == 2
+        assert (await RoleRepository.get(conn, 'role-new')).version == 1
+
+
+async def test_repositories_delete(loop, prepare_db, db, nomad_validator):
+    await insert_config(db)
+    await insert_role(db, nomad_validator)
+
+    async with db.connect() as conn:
+        assert await RoleRepository.delete(conn, 'role-test')
+        assert not await RoleRepository.delete(conn, 'role-test')
+        assert await RoleRepository.get(conn, 'role-test') is None
+
+        assert await ConfigRepository.delete(conn, 'gitlab.toliak.ru')
+        assert not await ConfigRepository.delete(conn, 'gitlab.toliak.ru')
+        assert await ConfigRepository.get_all(conn) == []
@@ -1,12 +1,25 @@
+import asyncio
 import json
+import socket
+import time
 
+import aiohttp
+import jwt
 import pytest
-from aiohttp.web_exceptions import HTTPBadRequest
-from nomad.api.exceptions import BadRequestNomadException
-
+from aiohttp import web
+from aiohttp.web_exceptions import HTTPBadRequest, HTTPServiceUnavailable
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt import PyJWTError
+from jwt.utils import base64url_encode
+
+from core import settings
+from core.cache import LruCache
 from core.exceptions import HTTPApiNomadClaimsValidationError, HTTPApiNomadClaimsCheckError, \
-    HTTPApiBoundClaimsCheckError
-from core.services import NomadClaimsService, NomadService, ConfigService, BoundClaimsService
+    HTTPApiBoundClaimsCheckError, HTTPApiConfigServiceJwksError
+from core.nomad_client import NomadClient, NomadApiError, NomadUnavailableError
+from core.services import NomadClaimsService, NomadService, ConfigService, BoundClaimsService, JwksEntry, ParsedToken, \
+    NomadClaimsMatcher, RegexClaim, CanonicalClaims
 
 
 def test_nomad_claims_service_validate_few_fields():
@@ -139,81 +152,331 @@ def test_nomad_claims_service_check_nomad_config_full_correct(nomad_config_json,
     assert NomadClaimsService.check_nomad_config(nomad_config_json, nomad_validator) is True
 
 
-def test_nomad_service_transform_correct(mocker,
-                                         nomad_hcl_job,
-                                         nomad_config_json):
-    def mock_function(*args, **kwargs):
-        mock_function.called = True
-        return nomad_config_json
+def test_nomad_claims_matcher(nomad_config_json, nomad_validator):
+    matcher = NomadClaimsMatcher(nomad_validator)
+    assert NomadClaimsService.check_nomad_config(nomad_config_json, matcher) is True
 
-    mock_function.called = False
+    name = dict(matcher.root.children)['Name']
+    assert type(name) == RegexClaim
+    assert name.pattern.pattern == '^test-deployer$'
 
-    mocker.patch('nomad.api.jobs.Jobs.parse', new=mock_function)
-    response = NomadService.transform(nomad_hcl_job)
+    nomad_config_json['TaskGroups'][0]['Tasks'][0]['Config']['network_aliases'].append('other')
+    with pytest.raises(HTTPApiNomadClaimsCheckError) as e:
+        matcher.check(nomad_config_json)
 
-    assert mock_function.called is True
-    assert type(response) == dict
+    assert 'ROOT.TaskGroups.0.Tasks.0.Config.network_aliases.1' in str(e)
 
 
-def test_nomad_service_transform_fail(mocker,
-                                      nomad_hcl_job,
-                                      nomad_config_json):
-    def mock_function(*args, **kwargs):
-        mock_function.called = True
-        raise BadRequestNomadException('something went wrong')
+def test_nomad_claims_matcher_type_mismatch(nomad_config_json):
+    matcher = NomadClaimsMatcher(dict(Name='^test-deployer$', Priority=8))
+    matcher.check(nomad_config_json)
 
-    mock_function.called = False
+    nomad_config_json['Name'] = 1
+    with pytest.raises(HTTPApiNomadClaimsCheckError) as e:
+        matcher.check(nomad_config_json)
 
-    mocker.patch('nomad.api.jobs.Jobs.parse', new=mock_function)
-    try:
-        NomadService.transform("""hey hello it's not hcl it's plain text ok""")
-        assert False
-    except HTTPBadRequest:
-        assert True
+    assert 'ROOT.Name' in str(e)
 
-    assert mock_function.called is True
+    nomad_config_json['Name'] = 'test-deployer'
+    nomad_config_json['Priority'] = 9
+    with pytest.raises(HTTPApiNomadClaimsCheckError) as e:
+        matcher.check(nomad_config_json)
+
+    assert 'ROOT.Priority' in str(e)
 
 
-def test_nomad_service_run_correct(mocker,
-                                   nomad_config_json):
-    def mock_function(*args, **kwargs):
-        mock_function.called = True
-        return json.loads('''{
-    "EvalID": "d1b4fc54-bf68-0a54-94ee-4460f41a13ba",
-    "EvalCreateIndex": 62498,
-    "JobModifyIndex": 62498,
-    "Warnings": "",
-    "Index": 62498,
-    "LastContact": 0,
-    "KnownLeader": false
-}''')
+def test_nomad_claims_service_compile_invalid_regex():
+    with pytest.raises(HTTPApiNomadClaimsValidationError) as e:
+        NomadClaimsService.compile(dict(TaskGroups=[dict(Name='^test-(deployer$')]))
+
+    assert 'ROOT.TaskGroups.0.Name' in str(e)
+    assert NomadClaimsService.compile(dict(TaskGroups=[dict()], Vault=dict())) is None
+
 
-    mock_function.called = False
+def test_canonical_claims():
+    claims = CanonicalClaims(dict(ref='master', project_id='77'), dict(Type='^service$', Name='^test$'))
+    same = CanonicalClaims(dict(project_id='77', ref='master'), dict(Name='^test$', Type='^service$'))
+    other = CanonicalClaims(dict(project_id='77', ref='master'), dict(Name='^test$'))
 
-    mocker.patch('core.services.NomadService.nomad_host.job.register_job', new=mock_function)
-    response = NomadService.run(nomad_config_json)
+    assert claims.bound_claims == '{"project_id":"77","ref":"master"}'
+    assert claims.hash == same.hash
+    assert claims.hash != other.hash
+    assert len(claims.hash) == 64
 
-    assert mock_function.called is True
-    assert type(response) == dict
 
+@pytest.fixture
+async def nomad_server(aiohttp_server, nomad_config_json):
+    requests = []
+    # RPC address of the leader
+    leader = dict(address='127.0.0.1:4647', version='1.6.1')
 
-def test_nomad_service_run_fail(mocker,
-                                nomad_hcl_job,
-                                nomad_config_json):
-    def mock_function(*args, **kwargs):
-        mock_function.called = True
-        raise BadRequestNomadException('something went wrong')
+    async def parse_handler(request):
+        data = await request.json()
+        requests.append(request)
+        if 'job' not in data['JobHCL']:
+            return web.Response(status=400, text='1:1: expected job')
 
-    mock_function.called = False
+        return web.json_response(nomad_config_json)
 
-    mocker.patch('core.services.NomadService.nomad_host.job.register_job', new=mock_function)
-    try:
-        NomadService.run(dict(Name="""hey hello it's not hcl it's plain text ok"""))
-        assert False
-    except HTTPBadRequest:
-        assert True
+    async def register_handler(request):
+        data = await request.json()
+        requests.append(request)
+        if request.match_info['job_id'] != data['Job']['Name']:
+            return web.Response(status=400, text='Job ID does not match name')
+
+        return web.json_response(dict(EvalID='d1b4fc54-bf68-0a54-94ee-4460f41a13ba', JobModifyIndex=62498))
+
+    async def plan_handler(request):
+        data = await request.json()
+        requests.append(request)
+        return web.json_response(dict(Diff=dict(Type='Added') if data['Diff'] else None))
+
+    async def read_handler(request):
+        requests.append(request)
+        if request.match_info['job_id'] != nomad_config_json['Name']:
+            return web.Response(status=404, text='job not found')
+
+        return web.json_response(nomad_config_json)
+
+    async def leader_handler(request):
+        requests.append(request)
+        return web.json_response(leader['address'])
+
+    async def agent_handler(request):
+        requests.append(request)
+        return web.json_response(dict(member=dict(Tags=dict(build=leader['version']))))
+
+    async def slow_handler(request):
+        # aiohttp rounds the timeout deadline up to the whole second
+        await asyncio.sleep(3)
+        return web.json_response({})
+
+    app = web.Application()
+    app.router.add_post('/v1/jobs/parse', parse_handler)
+    app.router.add_post('/v1/job/slow', slow_handler)
+    app.router.add_post('/v1/job/{job_id}', register_handler)
+    app.router.add_post('/v1/job/{job_id}/plan', plan_handler)
+    app.router.add_get('/v1/job/{job_id}', read_handler)
+    app.router.add_get('/v1/status/leader', leader_handler)
+    app.router.add_get('/v1/agent/self', agent_handler)
+    server = await aiohttp_server(app)
+    server.requests = requests
+    server.leader = leader
+    return server
+
+
+@pytest.fixture
+async def nomad_client(loop, nomad_server):
+    NomadService.parsed_jobs.clear()
+    async with aiohttp.ClientSession() as session:
+        yield NomadClient(session, [str(nomad_server.make_url('/'))],
+                          token='nomad-token',
+                          namespace='deployer',
+                          timeout=0.5)
+
+
+async def test_nomad_client(nomad_client, nomad_server, nomad_hcl_job, nomad_config_json):
+    assert await nomad_client.parse(nomad_hcl_job) == nomad_config_json
+    assert (await nomad_client.register('test-deployer', nomad_config_json))['JobModifyIndex'] == 62498
+    assert (await nomad_client.plan('test-deployer', nomad_config_json, diff=True))['Diff'] == dict(Type='Added')
+    assert await nomad_client.read('test-deployer') == nomad_config_json
+
+    for request in nomad_server.requests:
+        assert request.headers['X-Nomad-Token'] == 'nomad-token'
+        assert request.query['namespace'] == 'deployer'
+
+    with pytest.raises(NomadApiError) as e:
+        await nomad_client.read('not-exists')
+    assert e.value.status == 404
+    assert e.value.text == 'job not found'
+
+    with pytest.raises(NomadUnavailableError):
+        await nomad_client.register('slow', {})
+
+
+async def test_nomad_client_concurrent(nomad_client, nomad_hcl_job, nomad_config_json):
+    """
+    Nomad calls should not block the event loop
+    """
+    results = await asyncio.gather(*[nomad_client.parse(nomad_hcl_job) for _ in range(10)])
+    assert results == [nomad_config_json] * 10
+
+
+@pytest.fixture
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+
+    return f'http://127.0.0.1:{port}'
+
+
+async def test_nomad_client_failover(loop, nomad_server, closed_port_url, nomad_hcl_job, nomad_config_json, mocker):
+    """
+    Unavailable server should be skipped until it is healthy again
+    """
+    # The endpoints are tried in the configured order, the dead one first
+    mocker.patch('core.nomad_client.random.shuffle')
+
+    async with aiohttp.ClientSession() as session:
+        client = NomadClient(session, [closed_port_url, str(nomad_server.make_url('/'))], timeout=1)
+        dead, alive = client.endpoints
+
+        for _ in range(5):
+            assert await client.parse(nomad_hcl_job) == nomad_config_json
+        assert dead.failures == 1
+        assert not dead.is_healthy(time.time())
+        assert client.get_endpoints() == [alive, dead]
+
+        # The registration is retried, the connection has not been established
+        dead.mark_success()
+        for _ in range(5):
+            assert (await client.register('test-deployer', nomad_config_json))['JobModifyIndex'] == 62498
+
+        dead.mark_success()
+        await client.check_health()
+        assert not dead.is_healthy(time.time())
+        assert alive.is_healthy(time.time())
+        assert client.leader == '127.0.0.1'
+
+
+async def test_nomad_client_routing(loop, nomad_server, nomad_config_json):
+    async with aiohttp.ClientSession() as session:
+        client = NomadClient(session, ['http://localhost:4646', 'http://127.0.0.1:4646', 'http://other:4646'])
+        first, second, third = client.endpoints
+
+        first.outstanding = 2
+        second.outstanding = 1
+        assert client.get_endpoints() == [third, second, first]
+
+        client.leader = '127.0.0.1'
+        assert client.get_endpoints(leader=True) == [second, third, first]
+
+        third.mark_failure()
+        assert client.get_endpoints() == [second, first, third]
+
+    async with aiohttp.ClientSession() as session:
+        client = NomadClient(session, [str(nomad_server.make_url('/'))])
+        await client.check_health()
+        assert client.leader == '127.0.0.1'
+        assert await client.read('test-deployer') == nomad_config_json
+
+
+async def test_nomad_client_leader_host_name(loop, nomad_server, caplog):
+    """
+    The leader is reported by its IP, the endpoints configured by the host names should be resolved
+    """
+    url = str(nomad_server.make_url('/')).replace('127.0.0.1', 'localhost')
+
+    async with aiohttp.ClientSession() as session:
+        client = NomadClient(session, [url, 'http://127.0.0.2:4646'])
+        endpoint, other = client.endpoints
+        assert endpoint.ips == set()
+
+        await client.check_health()
+        assert client.leader == '127.0.0.1'
+        assert '127.0.0.1' in endpoint.ips
+        assert client.is_leader(endpoint)
+
+        other.mark_success()
+        endpoint.outstanding = 1
+        assert client.get_endpoints() == [other, endpoint]
+        assert client.get_endpoints(leader=True) == [endpoint, other]
+        assert 'does not match' not in caplog.text
+
+        nomad_server.leader['address'] = '10.0.0.1:4647'
+        await client.check_health()
+        assert client.leader == '10.0.0.1'
+        assert not client.is_leader(endpoint)
+        assert 'Nomad leader 10.0.0.1 does not match' in caplog.text
+
+
+async def test_nomad_service_transform_correct(nomad_client,
+                                               nomad_hcl_job,
+                                               nomad_config_json):
+    response = await NomadService.transform(nomad_client, nomad_hcl_job)
+    assert response == nomad_config_json
 
-    assert mock_function.called is True
+
+async def test_nomad_service_transform_cached(nomad_client, nomad_server, nomad_hcl_job, nomad_config_json):
+    responses = await asyncio.gather(*[NomadService.transform(nomad_client, nomad_hcl_job) for _ in range(5)])
+    assert responses == [nomad_config_json] * 5
+
+    # Every call gets its own copy
+    responses[0]['Name'] = 'changed'
+    assert await NomadService.transform(nomad_client, nomad_hcl_job) == nomad_config_json
+
+    assert [request.path for request in nomad_server.requests] == ['/v1/jobs/parse']
+
+
+async def test_nomad_service_transform_cache_dir(nomad_client, nomad_server, nomad_hcl_job, nomad_config_json,
+                                                 mocker, tmp_path):
+    mocker.patch('core.settings.nomad_parse_cache_dir', str(tmp_path))
+
+    def get_parse_count():
+        return len([request for request in nomad_server.requests if request.path == '/v1/jobs/parse'])
+
+    # The Nomad version is unknown, the parsed job is not persisted
+    assert await NomadService.transform(nomad_client, nomad_hcl_job) == nomad_config_json
+    assert list(tmp_path.glob('*.json')) == []
+
+    await nomad_client.check_health()
+    assert nomad_client.version == '1.6.1'
+    assert await NomadService.transform(nomad_client, nomad_hcl_job) == nomad_config_json
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    assert get_parse_count() == 2
+
+    # Restart: the memory cache is empty, the job is read from the directory
+    NomadService.parsed_jobs.clear()
+    assert await NomadService.transform(nomad_client, nomad_hcl_job) == nomad_config_json
+    assert get_parse_count() == 2
+
+    # Nomad upgrade: the job is parsed again
+    NomadService.parsed_jobs.clear()
+    nomad_server.leader['version'] = '1.7.0'
+    await nomad_client.check_health()
+    assert await NomadService.transform(nomad_client, nomad_hcl_job) == nomad_config_json
+    assert get_parse_count() == 3
+
+
+async def test_nomad_service_transform_cache_dir_size(nomad_client, nomad_hcl_job, mocker, tmp_path):
+    mocker.patch('core.settings.nomad_parse_cache_dir', str(tmp_path))
+    mocker.patch('core.settings.nomad_parse_cache_files', 2)
+    await nomad_client.check_health()
+
+    for index in range(5):
+        await NomadService.transform(nomad_client, f'{nomad_hcl_job}\n# {index}')
+    assert len(list(tmp_path.glob('*.json'))) == 2
+
+    # The directory is scanned once per tenth of the limit writes
+    mocker.patch('core.settings.nomad_parse_cache_files', 30)
+    mocker.patch.object(NomadService, 'parse_cache_writes', 0)
+    prune = mocker.spy(NomadService, 'prune_parse_cache_dir')
+    for index in range(40):
+        await NomadService.transform(nomad_client, f'{nomad_hcl_job}\n# next {index}')
+    assert prune.call_count == 40 // 3
+    assert len(list(tmp_path.glob('*.json'))) <= 30 + 3
+
+
+async def test_nomad_service_transform_fail(nomad_client):
+    with pytest.raises(HTTPBadRequest) as e:
+        await NomadService.transform(nomad_client, """hey hello it's not hcl it's plain text ok""")
+    assert 'expected job' in e.value.reason
+
+
+async def test_nomad_service_run_correct(nomad_client,
+                                         nomad_config_json):
+    response = await NomadService.run(nomad_client, nomad_config_json)
+    assert type(response) == dict
+    assert response['EvalID'] == 'd1b4fc54-bf68-0a54-94ee-4460f41a13ba'
+
+
+async def test_nomad_service_run_fail(nomad_client):
+    with pytest.raises(HTTPBadRequest):
+        await NomadService.run(nomad_client, dict(Type='service'))
+
+    with pytest.raises(HTTPServiceUnavailable):
+        await NomadService.run(nomad_client, dict(Name='slow'))
 
 
 def test_config_service_get_issuer(ci_job_jwt):
@@ -228,6 +491,329 @@ async def test_config_service_get_jwks():
     assert type(keys.get('keys')[0].get('n')) == str
 
 
+@pytest.fixture
+async def jwks_server(aiohttp_server, jwks_response):
+    async def jwks_handler(request):
+        jwks_handler.calls += 1
+        headers = {'Cache-Control': 'max-age=60', 'ETag': '"v1"'}
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(text=jwks_response, headers=headers)
+
+    async def broken_handler(request):
+        return web.Response(status=502)
+
+    async def html_handler(request):
+        return web.Response(text='<html>Sign in</html>', content_type='text/html')
+
+    async def not_object_handler(request):
+        return web.json_response(['keys'])
+
+    jwks_handler.calls = 0
+
+    app = web.Application()
+    app.router.add_get('/-/jwks', jwks_handler)
+    app.router.add_get('/-/broken', broken_handler)
+    app.router.add_get('/-/html', html_handler)
+    app.router.add_get('/-/not-object', not_object_handler)
+    server = await aiohttp_server(app)
+    server.jwks_handler = jwks_handler
+    return server
+
+
+async def test_config_service_fetch_jwks_shared_session(jwks_server):
+    async with aiohttp.ClientSession() as session:
+        entry = await ConfigService.fetch_jwks(str(jwks_server.make_url('/-/jwks')), session)
+        assert session.closed is False
+
+    assert type(entry.jwks.get('keys')) == list
+    assert entry.expires_at - entry.fetched_at == 60
+
+
+async def test_config_service_fetch_jwks_fail(jwks_server):
+    async with aiohttp.ClientSession() as session:
+        for path in ('/-/broken', '/-/html', '/-/not-object'):
+            with pytest.raises(HTTPApiConfigServiceJwksError):
+                await ConfigService.fetch_jwks(str(jwks_server.make_url(path)), session)
+
+
+def test_config_service_is_jwks_valid(jwks_response):
+    assert ConfigService.is_jwks_valid(json.loads(jwks_response)) is True
+    assert ConfigService.is_jwks_valid(dict(keys=[])) is True
+    assert ConfigService.is_jwks_valid(dict()) is False
+    assert ConfigService.is_jwks_valid(dict(keys='key')) is False
+    assert ConfigService.is_jwks_valid(dict(keys=['key'])) is False
+    assert ConfigService.is_jwks_valid('keys') is False
+
+
+async def test_config_service_fetch_jwks_conditional(jwks_server):
+    url = str(jwks_server.make_url('/-/jwks'))
+    async with aiohttp.ClientSession() as session:
+        entry = await ConfigService.fetch_jwks(url, session)
+        assert entry.etag == '"v1"'
+
+        revalidated = await ConfigService.fetch_jwks(url, session, entry)
+
+    assert jwks_server.jwks_handler.calls == 2
+    assert revalidated.jwks is entry.jwks
+    assert revalidated.etag == '"v1"'
+    assert revalidated.persisted is False
+
+
+async def test_config_service_refresh_jwks_stale(mocker, jwks_response):
+    async def mock_function(url, session=None, entry=None):
+        raise HTTPApiConfigServiceJwksError(url)
+
+    stale = JwksEntry(json.loads(jwks_response), 0, validated_at=time.time() - 60)
+    mocker.patch.object(ConfigService, 'jwks_cache', {'https://example.com/-/jwks': stale})
+    mocker.patch('core.services.ConfigService.fetch_jwks', new=mock_function)
+
+    assert await ConfigService.get_jwks('https://example.com/-/jwks') is stale.jwks
+    assert stale.is_fresh() is True
+
+    # Too old to be used
+    stale.expires_at = 0
+    stale.validated_at = time.time() - settings.jwks_max_stale
+    with pytest.raises(HTTPApiConfigServiceJwksError):
+        await ConfigService.get_jwks('https://example.com/-/jwks')
+
+
+def test_config_service_get_max_age():
+    assert ConfigService.get_max_age('max-age=120, public') == 120
+    assert ConfigService.get_max_age('no-cache') == 0
+    assert ConfigService.get_max_age('private, no-store') == 0
+    assert ConfigService.get_max_age('max-age=abc') == settings.jwks_cache_ttl
+    assert ConfigService.get_max_age(None) == settings.jwks_cache_ttl
+    assert ConfigService.get_max_age('max-age=999999999') == settings.jwks_cache_max_ttl
+
+
+@pytest.fixture
+def mock_fetch_jwks(mocker, jwks_response):
+    async def mock_function(url, session=None, entry=None):
+        mock_function.calls += 1
+        await asyncio.sleep(mock_function.delay)
+        return JwksEntry(json.loads(jwks_response), mock_function.ttl)
+
+    mock_function.calls = 0
+    mock_function.ttl = 300
+    mock_function.delay = 0
+
+    mocker.patch.object(ConfigService, 'jwks_cache', dict())
+    mocker.patch('core.services.ConfigService.fetch_jwks', new=mock_function)
+    return mock_function
+
+
+async def test_config_service_get_jwks_cached(mock_fetch_jwks):
+    kid = 'A3SlcGtHr508t5XA3AN_WL2r9Y4tdXmp4zA3wcPn8pM'
+    first = await ConfigService.get_jwks('https://example.com/-/jwks', kid)
+    second = await ConfigService.get_jwks('https://example.com/-/jwks', kid)
+
+    assert mock_fetch_jwks.calls == 1
+    assert first is second
+
+    await ConfigService.get_jwks('https://another.example.com/-/jwks')
+    assert mock_fetch_jwks.calls == 2
+
+
+async def test_config_service_get_jwks_single_flight(mock_fetch_jwks):
+    mock_fetch_jwks.delay = 0.05
+    results = await asyncio.gather(*[ConfigService.get_jwks('https://example.com/-/jwks') for _ in range(10)],
+                                   ConfigService.get_jwks('https://another.example.com/-/jwks'))
+
+    assert mock_fetch_jwks.calls == 2
+    assert all(result is results[0] for result in results[:10])
+    assert ConfigService.jwks_fetches.calls == dict()
+
+
+async def test_config_service_get_jwks_single_flight_fail(mocker, mock_fetch_jwks):
+    async def mock_function(url, session=None, entry=None):
+        mock_function.calls += 1
+        await asyncio.sleep(0.05)
+        raise HTTPApiConfigServiceJwksError(url)
+
+    mock_function.calls = 0
+    mocker.patch('core.services.ConfigService.fetch_jwks', new=mock_function)
+
+    results = await asyncio.gather(*[ConfigService.get_jwks('https://example.com/-/jwks') for _ in range(5)],
+                                   return_exceptions=True)
+    assert mock_function.calls == 1
+    assert all(isinstance(result, HTTPApiConfigServiceJwksError) for result in results)
+
+
+async def test_config_service_prefetch_jwks(mock_fetch_jwks):
+    assert await ConfigService.prefetch_jwks('https://example.com/-/jwks', 60) is True
+    assert await ConfigService.prefetch_jwks('https://example.com/-/jwks', 60) is False
+    assert mock_fetch_jwks.calls == 1
+
+    # Expires before the horizon
+    assert await ConfigService.prefetch_jwks('https://example.com/-/jwks', 600) is True
+    assert mock_fetch_jwks.calls == 2
+
+
+async def test_config_service_get_jwks_expired(mock_fetch_jwks):
+    mock_fetch_jwks.ttl = 0
+    await ConfigService.get_jwks('https://example.com/-/jwks')
+    await ConfigService.get_jwks('https://example.com/-/jwks')
+
+    assert mock_fetch_jwks.calls == 2
+
+
+async def test_config_service_get_jwks_unknown_kid(mocker, mock_fetch_jwks):
+    await ConfigService.get_jwks('https://example.com/-/jwks')
+
+    # Refresh is limited by the interval
+    await ConfigService.get_jwks('https://example.com/-/jwks', 'rotated-kid')
+    assert mock_fetch_jwks.calls == 1
+
+    mocker.patch('core.settings.jwks_refresh_min_interval', new=0)
+    await ConfigService.get_jwks('https://example.com/-/jwks', 'rotated-kid')
+    assert mock_fetch_jwks.calls == 2
+
+
+def test_config_service_get_public_key_registry(mocker, jwks_response):
+    mocker.patch.object(ConfigService, 'public_keys', dict())
+    jwks = json.loads(jwks_response)
+    kid = jwks['keys'][0]['kid']
+
+    key = ConfigService.get_public_key('gitlab.toliak.ru', kid, jwks)
+    assert ConfigService.get_public_key('gitlab.toliak.ru', kid, json.loads(jwks_response)) is key
+    assert ConfigService.get_public_key('gitlab.com', kid, jwks) is not key
+
+    # Same kid with another key material
+    jwks['keys'][0]['e'] = 'Aw'
+    assert ConfigService.get_public_key('gitlab.toliak.ru', kid, jwks) is not key
+
+
+def test_config_service_get_public_key_rotation(mocker, jwks_response):
+    mocker.patch.object(ConfigService, 'public_keys', dict())
+    jwks = json.loads(jwks_response)
+    kid = jwks['keys'][0]['kid']
+    ConfigService.get_public_key('gitlab.toliak.ru', kid, jwks)
+
+    jwks['keys'][0]['kid'] = 'rotated-kid'
+    ConfigService.get_public_key('gitlab.toliak.ru', 'rotated-kid', jwks)
+    assert list(ConfigService.public_keys) == [('gitlab.toliak.ru', 'rotated-kid')]
+
+    with pytest.raises(HTTPBadRequest) as e:
+        ConfigService.get_public_key('gitlab.toliak.ru', kid, jwks)
+
+    assert 'unknown kid' in str(e)
+
+
+def test_parsed_token(ci_job_jwt, ci_job_jwt_body):
+    token = ParsedToken(ci_job_jwt)
+    body = json.loads(ci_job_jwt_body)
+
+    assert token.payload['jti'] == body['jti']
+    assert token.payload['exp'] == body['exp']
+    assert token.issuer == 'gitlab.toliak.ru'
+    assert token.kid == 'A3SlcGtHr508t5XA3AN_WL2r9Y4tdXmp4zA3wcPn8pM'
+    assert token.header['alg'] == 'RS256'
+    assert token.signing_input == ci_job_jwt.rsplit('.', 1)[0].encode()
+
+
+def test_parsed_token_invalid(ci_job_jwt):
+    for encoded in ['', 'abc.def', ci_job_jwt.split('.', 1)[1]]:
+        with pytest.raises(PyJWTError):
+            ParsedToken(encoded)
+
+    # PyJWT does not encode these, the signature is not checked by the parsing
+    for header, payload in [(dict(alg='RS256', kid=['kid']), dict(iss='gitlab.toliak.ru')),
+                            (dict(alg='RS256', kid='kid'), dict(iss=['gitlab.toliak.ru']))]:
+        segments = [base64url_encode(json.dumps(value).encode()) for value in (header, payload)]
+        encoded = b'.'.join(segments + [base64url_encode(b'signature')]).decode()
+        with pytest.raises(jwt.InvalidTokenError):
+            ParsedToken(encoded)
+
+
+@pytest.fixture(scope='module')
+def rsa_private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def test_config_service_check_token_as_jwt_decode(rsa_private_key):
+    """
+    The token checks are built on the public PyJWT API, they should behave as jwt.decode of the pinned PyJWT
+    """
+    now = int(time.time())
+    public_key = rsa_private_key.public_key()
+    payloads = [
+        dict(iss='gitlab.toliak.ru'),
+        dict(exp=now + 60, nbf=now - 60, iat=now),
+        dict(exp=now - 60),
+        dict(exp='abc'),
+        dict(nbf=now + 60),
+        dict(nbf='abc'),
+        dict(iat='abc'),
+        dict(iat=now + 60),
+        dict(aud='deployer'),
+    ]
+
+    for payload in payloads:
+        encoded = jwt.encode(payload, rsa_private_key, algorithm='RS256', headers=dict(kid='kid'))
+        encoded = encoded.decode() if isinstance(encoded, bytes) else encoded
+
+        try:
+            expected = jwt.decode(encoded, public_key, algorithms=['RS256'])
+        except PyJWTError as e:
+            expected = type(e)
+
+        try:
+            token = ParsedToken(encoded)
+            ConfigService.check_token(token, public_key)
+            result = token.payload
+        except PyJWTError as e:
+            result = type(e)
+
+        assert result == expected, payload
+
+    encoded = jwt.encode(dict(exp=now + 60), rsa_private_key, algorithm='RS256')
+    encoded = encoded.decode() if isinstance(encoded, bytes) else encoded
+    for invalid in [encoded[:-4], encoded.replace('.', '..', 1), f'{encoded}.extra']:
+        with pytest.raises(PyJWTError):
+            jwt.decode(invalid, public_key, algorithms=['RS256'])
+        with pytest.raises(PyJWTError):
+            ConfigService.check_token(ParsedToken(invalid), public_key)
+
+
+def test_config_service_validate_cached(mocker, ci_job_jwt, jwks_response):
+    def mock_check_token(token, key):
+        mock_check_token.calls += 1
+
+    mock_check_token.calls = 0
+
+    token = ParsedToken(ci_job_jwt)
+    token.payload['exp'] = int(time.time()) + 60
+    jwks = json.loads(jwks_response)
+
+    mocker.patch.object(ConfigService, 'verified_tokens', LruCache(10))
+    mocker.patch('core.services.ConfigService.check_token', new=mock_check_token)
+
+    assert ConfigService.validate(token, jwks) == token.payload
+    assert ConfigService.validate(ParsedToken(ci_job_jwt), jwks) == token.payload
+    assert mock_check_token.calls == 1
+
+    # Signing key is not published anymore
+    jwks['keys'][0]['kid'] = 'rotated-kid'
+    with pytest.raises(HTTPBadRequest):
+        ConfigService.validate(token, jwks)
+
+
+def test_config_service_validate_cached_expired(mocker, ci_job_jwt, jwks_response):
+    def mock_check_token(token, key):
+        mock_check_token.calls += 1
+
+    mock_check_token.calls = 0
+
+    mocker.patch.object(ConfigService, 'verified_tokens', LruCache(10))
+    mocker.patch('core.services.ConfigService.check_token', new=mock_check_token)
+
+    ConfigService.validate(ci_job_jwt, json.loads(jwks_response))
+    ConfigService.validate(ci_job_jwt, json.loads(jwks_response))
+    assert mock_check_token.calls == 2
+
+
 async def test_config_service_validate_correct(ci_job_jwt,
                                                jwks_response):
     try: